@@ -1,8 +1,15 @@
 # SPDX-License-Identifier: GPL-3.0-or-later
 # Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
 
+import abc
 import configparser
+import contextlib
 import email
+import email.generator
+import fcntl
+import hashlib
+import io
+import json
 import logging
 import mailbox
 import os
@@ -10,12 +17,17 @@ import os.path
 import re
 import subprocess
 import sys
+import tempfile
+import threading
 import time
 
-from typing import Optional, Dict, Tuple, List, Union, Any
+from typing import Optional, Dict, Tuple, List, Set, Union, Any, BinaryIO
 from collections.abc import Iterator
 
 import jira
+import requests.adapters
+
+import jiramail.index
 
 
 __VERSION__ = '3'
@@ -23,6 +35,19 @@ __VERSION__ = '3'
 EX_SUCCESS = 0 # Successful exit status.
 EX_FAILURE = 1 # Failing exit status.
 
+# The number of messages written to the mailbox at once by Mailbox.batch().
+BATCH_SIZE = 256
+
+# The number of seconds the field metadata of jira is taken from the cache.
+META_TTL = 24 * 60 * 60
+
+# The number of requests per second sent to jira by all processes.
+RATE_LIMIT = 10.0
+
+# The number of connections to jira kept open for reuse by the threads of a
+# process.
+POOL_SIZE = 16
+
 logger = logging.getLogger("jiramail")
 
 
@@ -31,95 +56,792 @@ class Error:
         self.message = message
 
 
+def config_bool(config: Dict[str, Any], name: str, default: bool) -> bool:
+    if name not in config:
+        return default
+    return re.match(r'^(1|on|yes|true)$', str(config[name]), re.IGNORECASE) is not None
+
+
+def config_number(config: Dict[str, Any], name: str, default: Any) -> Any:
+    try:
+        return type(default)(config.get(name, default))
+    except ValueError:
+        return default
+
+
+def cache_dir() -> str:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache_home, "jiramail")
+
+
 class Connection:
-    def __init__(self, config_jira: Dict[str, Any]):
+    """
+    The list of jira fields is large and rarely changes, so it is kept in a
+    cache file and is requested from jira again only when the cache is
+    older than `meta_ttl` seconds. A stale cache is still used and updated
+    in the background.
+
+    One connection is shared by all threads of a process. Its session keeps
+    up to `pool_size` connections to jira open, so that concurrent requests
+    do not wait for a new TLS handshake.
+    """
+    def __init__(self, config_jira: Dict[str, Any], refresh_meta: bool = False):
         logger.debug("connecting to JIRA ...")
 
         self.config = config_jira
         jira_auth = self.config.get("auth", "<missing>")
 
+        timeout = config_number(self.config, "timeout", 0.0) or None
+
         match jira_auth:
             case "token":
                 self.jira = jira.JIRA(self.config["server"],
                                       token_auth=self.config["token"],
+                                      timeout=timeout,
                                       options={"check_update": False})
             case "basic":
                 self.jira = jira.JIRA(self.config["server"],
                                       basic_auth=(
                                           self.config["user"],
                                           self.config["password"]),
+                                      timeout=timeout,
                                       options={"check_update": False})
             case _:
                 raise KeyError(f"unknown method: jira.auth: {jira_auth}")
 
         logger.info("connected to JIRA")
 
+        self.refresh_meta = refresh_meta
+        self.meta_ttl = config_number(self.config, "meta_ttl", META_TTL)
+
+        self.fields_lock = threading.RLock()
+        self.fields_list: Optional[List[Dict[str, Any]]] = None
         self.fields_by_name: Dict[str, Dict[str, Any]] = {}
 
+        # The jira module requests the fields by itself to translate the
+        # field names in searches.
+        self.jira_fields = self.jira.fields
+        self.jira.fields = self.fields # type: ignore[method-assign]
+
+        # The scheduler of requests from jiramail.throttle.
+        self.scheduler: Optional[Any] = None
+        self.setup_session()
+
+    def server_digest(self) -> str:
+        return hashlib.sha1(self.jira.server_url.encode()).hexdigest()
+
+    def setup_session(self) -> None:
+        import jiramail.throttle
+
+        session = self.jira._session # pylint: disable=protected-access
+        pool_size = max(1, config_number(self.config, "pool_size", POOL_SIZE))
+        rate_limit = config_number(self.config, "rate_limit", RATE_LIMIT)
+
+        adapter: requests.adapters.HTTPAdapter
+
+        if rate_limit > 0:
+            self.scheduler = jiramail.throttle.RequestScheduler(
+                    os.path.join(cache_dir(), f"requests-{self.server_digest()}"), rate_limit)
+            adapter = jiramail.throttle.ThrottledAdapter(self.scheduler, pool_maxsize=pool_size)
+        else:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+        if not config_bool(self.config, "compression", True):
+            session.headers["Accept-Encoding"] = "identity"
+
+        if not config_bool(self.config, "keepalive", True):
+            session.headers["Connection"] = "close"
+
+    def report(self) -> None:
+        if self.scheduler is not None:
+            self.scheduler.report()
+
+    def fields_cache_path(self) -> str:
+        return os.path.join(cache_dir(), f"fields-{self.server_digest()}.json")
+
+    def read_fields_cache(self) -> Tuple[Optional[List[Dict[str, Any]]], float]:
+        path = self.fields_cache_path()
+        try:
+            with open(path, "r", encoding="utf-8") as fd:
+                data = json.load(fd)
+                mtime = os.fstat(fd.fileno()).st_mtime
+        except (OSError, ValueError):
+            return None, 0
+
+        if not isinstance(data, dict) or data.get("server") != self.jira.server_url or \
+                not isinstance(data.get("fields"), list):
+            return None, 0
+
+        return data["fields"], mtime
+
+    def write_fields_cache(self, fields: List[Dict[str, Any]]) -> None:
+        path = self.fields_cache_path()
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            with jiramail.index.replace_file(path) as fd:
+                json.dump({"server": self.jira.server_url, "fields": fields}, fd)
+
+        except OSError as e:
+            logger.warning("unable to save field metadata: %s", e)
+
+    def fetch_fields(self) -> List[Dict[str, Any]]:
+        logger.debug("requesting field metadata from jira ...")
+
+        fields = self.jira_fields()
+
+        if self.meta_ttl > 0:
+            self.write_fields_cache(fields)
+
+        return fields
+
+    def update_fields_cache(self) -> None:
+        try:
+            self.fetch_fields()
+        except Exception as e:
+            logger.warning("unable to update field metadata: %s", e)
+
+    def fields(self) -> List[Dict[str, Any]]:
+        with self.fields_lock:
+            return self.load_fields()
+
+    def load_fields(self) -> List[Dict[str, Any]]:
+        if self.fields_list is not None:
+            return self.fields_list
+
+        if self.meta_ttl > 0 and not self.refresh_meta:
+            fields, mtime = self.read_fields_cache()
+
+            if fields is not None:
+                if time.time() - mtime > self.meta_ttl:
+                    logger.debug("field metadata is stale, updating it in the background ...")
+                    threading.Thread(target=self.update_fields_cache, daemon=True).start()
+
+                self.fields_list = fields
+                return fields
+
+        self.fields_list = self.fetch_fields()
+        return self.fields_list
+
     def fill_fields(self) -> None:
         if self.fields_by_name:
             return
 
-        for v in self.jira.fields():
-            if "clauseNames" in v:
-                for n in v["clauseNames"]:
-                    self.fields_by_name[n.lower()] = v
-            self.fields_by_name[v["name"].lower()] = v
+        with self.fields_lock:
+            if self.fields_by_name:
+                return
+
+            fields_by_name: Dict[str, Dict[str, Any]] = {}
+
+            for v in self.fields():
+                if "clauseNames" in v:
+                    for n in v["clauseNames"]:
+                        fields_by_name[n.lower()] = v
+                fields_by_name[v["name"].lower()] = v
+
+            self.fields_by_name = fields_by_name
 
     def field_by_name(self, name: str, default: Dict[str, Any]) -> Dict[str, Any]:
         self.fill_fields()
         return self.fields_by_name.get(name, default)
 
+    def get_json(self, path: str, params: Dict[str, Any]) -> Any:
+        # The jira module has no public methods for the paged resources.
+        return self.jira._get_json(path, params=params) # pylint: disable=protected-access
+
 
 jserv: Connection
 
 
-class Mailbox:
+def mail_flags(mail: email.message.Message) -> str:
+    if isinstance(mail, mailbox.mboxMessage):
+        return mail.get_flags()
+    return str(mail.get("Status", "")) + str(mail.get("X-Status", ""))
+
+
+def mbox_message(mail: email.message.Message) -> bytes:
+    """
+    Returns the message in the same form as mailbox.mbox writes it but
+    without the empty line that separates messages.
+    """
+    from_line = None
+
+    if isinstance(mail, mailbox.mboxMessage):
+        from_line = "From " + mail.get_from()
+    else:
+        from_line = mail.get_unixfrom()
+
+    if from_line is None:
+        from_line = "From MAILER-DAEMON " + time.asctime(time.gmtime())
+
+    buf = io.BytesIO()
+    email.generator.BytesGenerator(buf, True, 0).flatten(mail)
+
+    data = buf.getvalue()
+    if not data.endswith(b"\n"):
+        data += b"\n"
+
+    return from_line.encode("ascii") + b"\n" + data
+
+
+class Mailbox(abc.ABC):
+    """
+    The interface of mailbox formats. A format must implement the abstract
+    methods, the others have defaults that are suitable for most formats.
+    """
     def __init__(self, path: str):
         logger.debug("openning the mailbox `%s' ...", path)
 
-        self.mbox = mailbox.mbox(path)
         self.path = os.path.abspath(os.path.expanduser(path))
+        self.msgid = jiramail.index.MessageIds()
         self.n_msgs = 0
-        self.msgid = {}
 
-        for key in self.mbox.iterkeys():
-            mail = self.mbox.get_message(key)
-            if "Message-Id" in mail:
-                msg_id = mail.get("Message-Id")
-                self.msgid[msg_id] = True
-            self.n_msgs += 1
+        # Changes each time messages are added or removed, so that a reader
+        # can tell that its list of keys is out of date.
+        self.generation = 0
 
-        logger.info("mailbox is ready")
+    @abc.abstractmethod
+    def get_message(self, key: Any) -> mailbox.mboxMessage:
+        ...
 
-    def get_message(self, key: str) -> mailbox.mboxMessage:
-        return self.mbox.get_message(key)
+    @abc.abstractmethod
+    def get_flags(self, key: Any) -> str:
+        ...
 
-    def del_message(self, key: str) -> None:
+    def set_flags(self, key: Any, flags: str) -> None:
         mail = self.get_message(key)
-        msg_id = mail.get("Message-Id")
+        mail.set_flags(flags)
+        self.update_message(key, mail)
+
+    @abc.abstractmethod
+    def del_message(self, key: Any) -> None:
+        ...
 
-        self.mbox.remove(key)
-        del self.msgid[msg_id]
+    @abc.abstractmethod
+    def update_message(self, key: Any, mail: email.message.Message) -> None:
+        ...
 
-    def update_message(self, key: str, mail: email.message.Message) -> None:
-        self.mbox.update([(key, mail)])
+    @abc.abstractmethod
+    def add_message(self, mail: email.message.Message) -> None:
+        ...
 
     def append(self, mail: email.message.Message) -> None:
         msg_id = mail.get("Message-Id")
 
         if msg_id not in self.msgid:
-            self.mbox.add(mail)
-            self.msgid[msg_id] = True
+            self.add_message(mail)
+            self.msgid.add(msg_id)
+            self.n_msgs += 1
+            self.generation += 1
+
+    @contextlib.contextmanager
+    def batch(self, size: int = BATCH_SIZE) -> Iterator[None]: # pylint: disable=unused-argument
+        try:
+            yield
+        finally:
+            self.sync()
 
+    @abc.abstractmethod
     def iterkeys(self) -> Iterator[Any]:
-        return self.mbox.iterkeys()
+        ...
+
+    def persistent_id(self, key: Any) -> Any:
+        """
+        Returns the identifier of the message that does not change when
+        the mailbox is rewritten by another process.
+        """
+        return key
+
+    def refresh(self) -> bool:
+        """
+        Picks up messages added to the mailbox by other processes. Returns
+        True if the list of messages has changed.
+        """
+        return False
+
+    def need_compact(self) -> bool:
+        return False
+
+    def compact(self) -> None:
+        self.sync()
 
+    @abc.abstractmethod
     def sync(self) -> None:
-        self.mbox.flush()
+        ...
 
+    def flush(self) -> None:
+        """
+        Makes sure that the messages added so far are stored in the mailbox.
+        Unlike sync(), it does not have to update anything else.
+        """
+        self.sync()
+
+    @abc.abstractmethod
     def close(self) -> None:
-        self.mbox.close()
+        ...
+
+
+class MboxMailbox(Mailbox):
+    """
+    The mailbox can be shared by several processes. Appending to the mailbox,
+    changing flags and rewriting it are done under the exclusive lock and
+    the messages appended by other processes are picked up by refresh().
+    Messages are read without the lock because their data is never changed
+    in place.
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+
+        self.lock = jiramail.index.MailboxLock(self.path)
+        self.flags = jiramail.index.MailboxFlags(self.path)
+
+        # Messages that are not written to the mailbox file yet.
+        self.pending: List[Tuple[jiramail.index.IndexEntry, bytes]] = []
+        self.batch_size = 0
+        self.batching = 0
+
+        # The mailbox file must be rewritten because some messages have been
+        # changed.
+        self.dirty = False
+
+        self.load()
+        self.save_index()
+
+        logger.info("mailbox is ready")
+
+    def open_file(self) -> BinaryIO:
+        try:
+            return open(self.path, "rb+")
+        except FileNotFoundError:
+            return open(self.path, "wb+")
+        except PermissionError:
+            return open(self.path, "rb")
+
+    def load(self) -> None:
+        self.file = self.open_file()
+        self.index = jiramail.index.MailboxIndex(self.path)
+
+        # The index must be written to disk.
+        self.changed = False
+
+        with self.lock.shared():
+            if not self.index.load():
+                self.rebuild_index()
+            elif self.index.is_valid(self.file):
+                logger.debug("using mailbox index `%s'", self.index.path)
+            elif self.index.has_grown(self.file):
+                self.update_index()
+            else:
+                self.rebuild_index()
+
+            # The end of the part of the mailbox file that is indexed.
+            self.end = os.fstat(self.file.fileno()).st_size
+            self.index_mtime = self.index.mtime_ns()
+
+            self.flags.load()
+
+        self.msgid = jiramail.index.MessageIds()
+        self.n_msgs = 0
+
+        for entry in self.index.entries:
+            if entry.deleted:
+                continue
+            if entry.ident:
+                self.msgid.add_packed(entry.ident)
+            self.n_msgs += 1
+
+        # Messages added, but not written yet.
+        for entry, _ in self.pending:
+            if entry.ident:
+                self.msgid.add_packed(entry.ident)
+            self.n_msgs += 1
+
+        self.next_key = len(self.index.entries)
+        self.generation += 1
+
+    def rebuild_index(self) -> None:
+        logger.debug("indexing the mailbox `%s' ...", self.path)
+
+        # Messages removed from the mailbox remain removed even if the index
+        # is no longer valid.
+        deleted = self.index.deleted()
+
+        self.index.entries = []
+        self.scan(0)
+
+        for entry in self.index.entries:
+            if entry.msgid in deleted:
+                entry.deleted = True
+
+    def update_index(self) -> None:
+        logger.debug("indexing new messages of the mailbox `%s' from offset %d ...",
+                     self.path, self.index.size)
+
+        self.scan(self.index.size)
+
+    def scan(self, pos: int) -> None:
+        for start, stop, headers in jiramail.index.scan_headers(self.file, pos,
+                                                                ["Message-Id", "Status", "X-Status"]):
+            self.index.entries.append(jiramail.index.IndexEntry(
+                    start, stop - start,
+                    headers.get("Status", "") + headers.get("X-Status", ""),
+                    headers.get("Message-Id", "")))
+
+        self.changed = True
+
+    def refresh(self) -> bool:
+        with self.lock.shared():
+            return self.refresh_locked()
+
+    def refresh_locked(self) -> bool:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+
+        fst = os.fstat(self.file.fileno())
+
+        if (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino) or fst.st_size < self.end:
+            logger.debug("mailbox `%s' has been rewritten, reloading ...", self.path)
+
+            # Messages removed by this process, but not saved in the index
+            # yet, remain removed in the new version of the mailbox.
+            deleted = self.index.deleted()
+
+            self.file.close()
+            self.load()
+            self.apply_deleted(deleted)
+            return True
+
+        self.flags.refresh()
+
+        if fst.st_size == self.end:
+            return False
+
+        logger.debug("indexing messages appended to the mailbox `%s' ...", self.path)
+
+        first = len(self.index.entries)
+
+        self.scan(self.end)
+        self.end = fst.st_size
+
+        for entry in self.index.entries[first:]:
+            if entry.ident:
+                self.msgid.add_packed(entry.ident)
+            self.n_msgs += 1
+
+        self.next_key = len(self.index.entries)
+
+        if self.next_key == first:
+            return False
+
+        self.generation += 1
+        return True
+
+    def merge_deleted(self) -> None:
+        # Another process could remove messages and save the index since it
+        # was read.
+        if self.index.mtime_ns() == self.index_mtime:
+            return
+
+        other = jiramail.index.MailboxIndex(self.path)
+        if not other.load():
+            return
+
+        self.apply_deleted(other.deleted())
+        self.index_mtime = other.mtime_ns()
+
+    def apply_deleted(self, deleted: Set[str]) -> None:
+        for entry in self.index.entries:
+            if not entry.deleted and entry.msgid in deleted:
+                entry.deleted = True
+                self.msgid.discard(entry.msgid)
+                self.n_msgs -= 1
+                self.generation += 1
+                self.changed = True
+
+    def save_index(self) -> None:
+        self.write_pending()
+
+        if not self.changed:
+            return
+
+        with self.lock.exclusive():
+            self.refresh_locked()
+            self.merge_deleted()
+
+            self.file.flush()
+            self.index.stamp(self.file)
+
+            try:
+                self.index.save()
+            except OSError as e:
+                logger.warning("unable to save mailbox index: %s", e)
+                return
+
+            self.index_mtime = self.index.mtime_ns()
+
+        self.changed = False
+
+    def read_message(self, offset: int, length: int) -> mailbox.mboxMessage:
+        self.file.seek(offset)
+        from_line = self.file.readline().rstrip(b"\n")
+        data = self.file.read(offset + length - self.file.tell())
+
+        mail = mailbox.mboxMessage(data)
+        mail.set_from(from_line[5:].decode("ascii"))
+
+        return mail
+
+    def write_entries(self, items: List[Tuple[jiramail.index.IndexEntry, bytes]]) -> None:
+        # The caller must hold the exclusive lock and refresh the index first.
+        data = []
+
+        self.file.seek(0, io.SEEK_END)
+        offset = self.file.tell()
+
+        for entry, message in items:
+            entry.offset = offset
+            offset += len(message) + 1
+            data.extend([message, b"\n"])
+
+        self.file.writelines(data)
+        self.file.flush()
+
+        self.end = offset
+        self.changed = True
+
+    def write_pending(self, fsync: bool = False) -> None:
+        if not self.pending:
+            return
+
+        with self.lock.exclusive():
+            self.refresh_locked()
+            self.write_entries(self.pending)
+
+            if fsync:
+                os.fsync(self.file.fileno())
+
+        for entry, _ in self.pending:
+            self.index.entries.append(entry)
+            self.next_key += 1
+
+        self.pending = []
+
+    @contextlib.contextmanager
+    def batch(self, size: int = BATCH_SIZE) -> Iterator[None]:
+        """
+        Messages added inside the batch are written to the mailbox file by
+        groups of the specified size with one write and one fsync.
+        """
+        prev_size = self.batch_size
+
+        self.batch_size = size
+        self.batching += 1
+        try:
+            yield
+        finally:
+            self.write_pending(fsync=True)
+            self.batching -= 1
+            self.batch_size = prev_size
+
+    def rewrite(self) -> None:
+        logger.debug("rewriting the mailbox `%s' ...", self.path)
+
+        self.write_pending()
+
+        dirname, basename = os.path.split(self.path)
+        entries: List[jiramail.index.IndexEntry] = []
+
+        with self.lock.exclusive():
+            self.refresh_locked()
+            self.merge_deleted()
+
+            with tempfile.NamedTemporaryFile("wb", dir=dirname, prefix=basename,
+                                             delete=False) as fd:
+                try:
+                    for entry in self.index.entries:
+                        if entry.deleted:
+                            continue
+
+                        self.file.seek(entry.offset)
+                        data = self.file.read(entry.length)
+                        flags = self.flags.get(entry.msgid, entry.flags)
+
+                        if flags != entry.flags:
+                            data = jiramail.index.replace_flags(data, flags)
+
+                        entries.append(jiramail.index.IndexEntry(
+                                fd.tell(), len(data), flags, entry.msgid))
+                        fd.write(data + b"\n")
+
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                    os.chmod(fd.name, os.stat(self.path).st_mode)
+
+                except BaseException:
+                    os.unlink(fd.name)
+                    raise
+
+            os.replace(fd.name, self.path)
+
+            self.file.close()
+            self.file = self.open_file()
+
+            self.index.entries = entries
+            self.next_key = len(entries)
+            self.end = os.fstat(self.file.fileno()).st_size
+            self.dirty = False
+            self.changed = True
+
+            # All flags are in the mailbox now.
+            self.flags.clear()
+
+            self.save_index()
+
+    def lookup(self, key: int) -> jiramail.index.IndexEntry:
+        if not 0 <= key < len(self.index.entries):
+            raise KeyError(key)
+        entry = self.index.entries[key]
+        if entry.deleted:
+            raise KeyError(key)
+        return entry
+
+    def get_message(self, key: int) -> mailbox.mboxMessage:
+        entry = self.lookup(key)
+        mail = self.read_message(entry.offset, entry.length)
+
+        if entry.msgid in self.flags.flags:
+            mail.set_flags(self.flags.get(entry.msgid, entry.flags))
+
+        return mail
+
+    def get_flags(self, key: int) -> str:
+        entry = self.lookup(key)
+        return self.flags.get(entry.msgid, entry.flags)
+
+    def set_flags(self, key: int, flags: str) -> None:
+        entry = self.lookup(key)
+
+        if not entry.msgid:
+            super().set_flags(key, flags)
+            return
+
+        with self.lock.exclusive():
+            self.flags.set(entry.msgid, flags)
+
+    def del_message(self, key: int) -> None:
+        # The message stays in the mailbox file until the next compaction.
+        entry = self.lookup(key)
+        entry.deleted = True
+
+        self.msgid.discard(entry.msgid)
+        self.n_msgs -= 1
+        self.generation += 1
+        self.changed = True
+
+    def update_message(self, key: int, mail: email.message.Message) -> None:
+        # Like mailbox.mbox, the new version of the message is written to the
+        # end of the file and the old one is dropped when the mailbox is synced.
+        self.lookup(key)
+
+        message = mbox_message(mail)
+        entry = jiramail.index.IndexEntry(-1, len(message), mail_flags(mail),
+                                          str(mail.get("Message-Id", "")))
+
+        with self.lock.exclusive():
+            self.refresh_locked()
+            self.write_entries([(entry, message)])
+
+            if entry.msgid in self.flags.flags:
+                self.flags.set(entry.msgid, entry.flags)
+
+        self.index.entries[key] = entry
+        self.dirty = True
+
+    def add_message(self, mail: email.message.Message) -> None:
+        message = mbox_message(mail)
+        entry = jiramail.index.IndexEntry(-1, len(message), mail_flags(mail),
+                                          str(mail.get("Message-Id", "")))
+
+        self.pending.append((entry, message))
+
+        if not self.batching or len(self.pending) >= self.batch_size:
+            self.write_pending()
+
+    def iterkeys(self) -> Iterator[Any]:
+        self.write_pending()
+        return iter([k for k, v in enumerate(self.index.entries) if not v.deleted])
+
+    def persistent_id(self, key: int) -> Any:
+        # The keys are renumbered when the mailbox is reloaded after it has
+        # been compacted.
+        return self.lookup(key).msgid or key
+
+    def need_compact(self) -> bool:
+        if self.dirty or self.flags.flags:
+            return True
+        return self.n_msgs != len(self.index.entries)
+
+    def compact(self) -> None:
+        self.rewrite()
+
+    def sync(self) -> None:
+        if self.dirty:
+            self.rewrite()
+        self.save_index()
+
+    def flush(self) -> None:
+        # The index is brought up to date from the mailbox file when it is
+        # opened next time.
+        self.write_pending(fsync=True)
+
+    def close(self) -> None:
+        if self.file.writable():
+            self.sync()
+        self.file.close()
+        self.lock.close()
+
+
+def mailbox_format(path: str, fmt: str = "") -> str:
+    if fmt:
+        return fmt.lower()
+
+    path = os.path.expanduser(path)
+
+    if os.path.isdir(path):
+        if os.path.exists(os.path.join(path, ".mh_sequences")):
+            return "mh"
+        return "maildir"
+
+    # Like mutt, a trailing slash means a Maildir that has not been created yet.
+    if path.endswith("/"):
+        return "maildir"
+
+    if path.endswith((".sqlite", ".sqlite3", ".db")):
+        return "sqlite"
+
+    return "mbox"
+
+
+def open_mailbox(path: str, fmt: str = "") -> Mailbox:
+    fmt = mailbox_format(path, fmt)
+
+    match fmt:
+        case "mbox":
+            return MboxMailbox(path)
+        case "maildir" | "mh":
+            import jiramail.maildir
+            return jiramail.maildir.MaildirMailbox(path, fmt)
+        case "sqlite":
+            import jiramail.sqlite
+            return jiramail.sqlite.SqliteMailbox(path)
+
+    raise ValueError(f"unknown mailbox format: {fmt}")
 
 
 def _run_command(cmdargs: List[str], stdin: Optional[bytes] = None,
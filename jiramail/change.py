@@ -582,7 +582,7 @@ def main(cmdargs: argparse.Namespace) -> int:
         return jiramail.EX_FAILURE
 
     try:
-        jiramail.jserv = jiramail.Connection(config.get("jira", {}))
+        jiramail.jserv = jiramail.Connection(config.get("jira", {}), cmdargs.refresh_meta)
     except Exception as e:
         logger.critical("unable to connect to jira: %s", e)
         return jiramail.EX_FAILURE
@@ -593,23 +593,28 @@ def main(cmdargs: argparse.Namespace) -> int:
         replies: List[email.message.EmailMessage] = []
 
         try:
-            mbox = jiramail.Mailbox(cmdargs.mailbox)
+            mbox = jiramail.open_mailbox(cmdargs.mailbox)
         except Exception as e:
             logger.critical("unable to open mailbox: %s", e)
             return jiramail.EX_FAILURE
 
         for key in mbox.iterkeys():
-            mail = mbox.get_message(key)
-
-            flags = mail.get_flags()
-            if "A" in flags:
+            if "A" in mbox.get_flags(key):
                 continue
 
+            mail = mbox.get_message(key)
+            issue_id = mail.get("X-Jiramail-Issue-Id")
+
             if not process_mail(mail, replies):
                 rc = jiramail.EX_FAILURE
 
-            set_mail_flags(mail, "ROA")
-            mbox.update_message(key, mail)
+            # The message is rewritten only if a new issue has been created
+            # from it. Otherwise, it is enough to mark it as answered.
+            if mail.get("X-Jiramail-Issue-Id") != issue_id:
+                set_mail_flags(mail, "ROA")
+                mbox.update_message(key, mail)
+            else:
+                mbox.set_flags(key, "ROA")
 
         if cmdargs.stdin:
             stdin_mail = email.message_from_file(sys.stdin)
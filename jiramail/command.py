@@ -43,6 +43,16 @@ def cmd_imap(cmdargs: argparse.Namespace) -> int:
     return jiramail.imap.main(cmdargs)
 
 
+def cmd_export(cmdargs: argparse.Namespace) -> int:
+    import jiramail.export
+    return jiramail.export.main(cmdargs)
+
+
+def cmd_compact(cmdargs: argparse.Namespace) -> int:
+    import jiramail.compact
+    return jiramail.compact.main(cmdargs)
+
+
 def add_common_arguments(parser: argparse.ArgumentParser) -> None:
     parser.add_argument("-v", "--verbose",
                         dest="verbose", action='count', default=0,
@@ -59,6 +69,12 @@ def add_common_arguments(parser: argparse.ArgumentParser) -> None:
                         help="show this help message and exit.")
 
 
+def add_connection_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--refresh-meta",
+                        dest="refresh_meta", action="store_true",
+                        help="request the field metadata from jira instead of the cache.")
+
+
 def setup_parser() -> argparse.ArgumentParser:
     epilog = "Report bugs to authors."
 
@@ -105,8 +121,39 @@ changes will also be saved.
     sp0.add_argument("--issue",
                      dest="issues", action="append", default=[], metavar="ISSUE-123",
                      help="specify the issues to export.")
+    sp0.add_argument("--issue-batch",
+                     dest="issue_batch", action="store", type=int, default=50, metavar="NUM",
+                     help="request the issues given with --issue by searches of NUM keys (default: %(default)s).")
+    sp0.add_argument("--resume",
+                     dest="resume", action="store_true",
+                     help="continue the queries of an interrupted run after the last saved page.")
+    sp0.add_argument("--shard-size",
+                     dest="shard_size", action="store", type=int, default=0, metavar="NUM",
+                     help="split queries with more than NUM issues into shards by date and page through --jobs shards at the same time.")
+    sp0.add_argument("--shard-field",
+                     dest="shard_field", action="store", choices=["created", "updated"], default="created",
+                     help="date field by which queries are split into shards (default: %(default)s).")
+    sp0.add_argument("--full",
+                     dest="full", action="store_true",
+                     help="render all changes and comments of the issues written to the mailbox before.")
+    sp0.add_argument("--only-changed",
+                     dest="only_changed", action="store_true",
+                     help="list the issues first and retrieve only those that have changed since the previous run.")
+    sp0.add_argument("-j", "--jobs",
+                     dest="jobs", action="store", type=int, default=1, metavar="NUM",
+                     help="number of search requests sent to jira at the same time (default: %(default)s).")
+    sp0.add_argument("--render-procs",
+                     dest="procs", action="store", type=int, default=0, metavar="NUM",
+                     help="render emails in NUM worker processes (default: in a thread of the main process).")
+    sp0.add_argument("--fields",
+                     dest="fields", action="store", default="", metavar="LIST",
+                     help="comma-separated list of issue fields to request from jira (default: the fields shown in emails).")
+    sp0.add_argument("--batch-size",
+                     dest="batch_size", action="store", type=int, default=jiramail.BATCH_SIZE, metavar="NUM",
+                     help="write messages to the mailbox by groups of NUM messages (default: %(default)s).")
     sp0.add_argument("mailbox",
                      help="path to mailbox where emails should be added.")
+    add_connection_arguments(sp0)
     add_common_arguments(sp0)
 
     # jiramail change
@@ -133,6 +180,7 @@ by default the utility will add a letter with a report on the executed commands.
                      help="accept a mail stream on standard input, process commands from it and write it to mailbox.")
     sp1.add_argument("mailbox",
                      help="path to mailbox with commands.")
+    add_connection_arguments(sp1)
     add_common_arguments(sp1)
 
     # jiramail subs
@@ -147,6 +195,11 @@ read from the configuration file.
                                 epilog=epilog,
                                 add_help=False)
     sp2.set_defaults(func=cmd_subs)
+
+    sp2.add_argument("--full",
+                     dest="full", action="store_true",
+                     help="ignore the time of the previous sync and request all issues of the queries.")
+    add_connection_arguments(sp2)
     add_common_arguments(sp2)
 
     # jiramail info
@@ -164,6 +217,7 @@ retrieves issue information from the jira API.
     sp3.add_argument("--issue",
                      dest="issue", action="store", default=None, metavar="ISSUE-123",
                      help="specify the issue to export.")
+    add_connection_arguments(sp3)
     add_common_arguments(sp3)
 
     # jiramail smtp
@@ -187,6 +241,7 @@ easier way to send commands.
     sp4.add_argument("-m", "--mailbox",
                      dest="mailbox", action="store", default="",
                      help="path to mailbox to store a reply messages with the status of command execution.")
+    add_connection_arguments(sp4)
     add_common_arguments(sp4)
 
     # jiramail imap
@@ -201,6 +256,47 @@ imap server
     sp5.set_defaults(func=cmd_imap)
     add_common_arguments(sp5)
 
+    # jiramail export
+    sp6_description = """\
+copies messages from one mailbox to another. It can be used to get a plain mbox
+from a Maildir or SQLite mailbox. Messages that already exist in the target
+mailbox are skipped.
+
+"""
+    sp6 = subparsers.add_parser("export",
+                                description=sp6_description,
+                                help=sp6_description,
+                                epilog=epilog,
+                                add_help=False)
+    sp6.set_defaults(func=cmd_export)
+
+    sp6.add_argument("--format",
+                     dest="format", action="store", default="", metavar="FORMAT",
+                     help="format of the target mailbox (mbox, maildir, mh, sqlite).")
+    sp6.add_argument("source",
+                     help="path to mailbox to export from.")
+    sp6.add_argument("target",
+                     help="path to mailbox where emails should be added.")
+    add_common_arguments(sp6)
+
+    # jiramail compact
+    sp7_description = """\
+removes deleted messages from the mailbox and writes changed flags into it. If
+no mailboxes are specified, all mailboxes from the subscriptions are compacted.
+
+"""
+    sp7 = subparsers.add_parser("compact",
+                                description=sp7_description,
+                                help=sp7_description,
+                                epilog=epilog,
+                                add_help=False)
+    sp7.set_defaults(func=cmd_compact)
+
+    sp7.add_argument("mailboxes",
+                     nargs="*", metavar="mailbox",
+                     help="path to mailbox to compact.")
+    add_common_arguments(sp7)
+
 
     return parser
 
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import argparse
+
+from typing import Dict, Any
+
+import jiramail
+import jiramail.subs
+
+logger = jiramail.logger
+
+
+def get_mailboxes(config: Dict[str, Any]) -> Dict[str, str]:
+    mailboxes: Dict[str, str] = {}
+
+    for target in config.get(jiramail.subs.config_section, {}):
+        mailbox = jiramail.subs.get_mailbox(config, target)
+        if mailbox:
+            mailboxes[mailbox] = jiramail.subs.get_format(config, target)
+
+    return mailboxes
+
+
+def compact_mailbox(path: str, fmt: str, force: bool = True) -> bool:
+    try:
+        mbox = jiramail.open_mailbox(path, fmt)
+    except Exception as e:
+        logger.critical("unable to open mailbox: %s", e)
+        return False
+
+    if force or mbox.need_compact():
+        logger.info("compacting the mailbox `%s' ...", path)
+        mbox.compact()
+
+    mbox.close()
+    return True
+
+
+def main(cmdargs: argparse.Namespace) -> int:
+    mailboxes: Dict[str, str] = {}
+
+    if cmdargs.mailboxes:
+        for mailbox in cmdargs.mailboxes:
+            mailboxes[mailbox] = ""
+    else:
+        config = jiramail.read_config()
+
+        if isinstance(config, jiramail.Error):
+            logger.critical("%s", config.message)
+            return jiramail.EX_FAILURE
+
+        mailboxes = get_mailboxes(config)
+
+    ret = jiramail.EX_SUCCESS
+
+    for mailbox, fmt in mailboxes.items():
+        if not compact_mailbox(mailbox, fmt):
+            ret = jiramail.EX_FAILURE
+
+    return ret
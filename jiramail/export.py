@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import argparse
+
+import jiramail
+
+logger = jiramail.logger
+
+
+def main(cmdargs: argparse.Namespace) -> int:
+    try:
+        source = jiramail.open_mailbox(cmdargs.source)
+    except Exception as e:
+        logger.critical("unable to open mailbox: %s", e)
+        return jiramail.EX_FAILURE
+
+    try:
+        target = jiramail.open_mailbox(cmdargs.target, cmdargs.format)
+    except Exception as e:
+        logger.critical("unable to open mailbox: %s", e)
+        source.close()
+        return jiramail.EX_FAILURE
+
+    n_msgs = target.n_msgs
+
+    with target.batch():
+        for key in source.iterkeys():
+            target.append(source.get_message(key))
+
+    logger.info("%d messages exported to `%s'", target.n_msgs - n_msgs, cmdargs.target)
+
+    target.close()
+    source.close()
+
+    return jiramail.EX_SUCCESS
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import collections
+import concurrent.futures
+import itertools
+
+from datetime import datetime
+
+from typing import Optional, Dict, List, Tuple, Callable, Any
+
+from collections.abc import Iterator, Iterable, Generator
+
+import jira
+import jira.exceptions
+
+import jiramail
+import jiramail.state
+
+logger = jiramail.logger
+
+# The number of changes or comments requested at once for an issue whose
+# history does not fit into the search results.
+PAGE_SIZE = 100
+
+
+def fetch_ordered(func: Callable[[Any], Any], items: Iterable[Any], jobs: int) -> Iterator[Any]:
+    """
+    Calls func for the items in up to `jobs` threads and yields the results
+    in the order of the items. Only a few results are fetched ahead, so the
+    caller can write them out while the next ones are being received.
+    """
+    if jobs <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    queue: collections.deque[concurrent.futures.Future[Any]] = collections.deque()
+
+    try:
+        for item in items:
+            queue.append(pool.submit(func, item))
+
+            if len(queue) >= 2 * jobs:
+                yield queue.popleft().result()
+
+        while queue:
+            yield queue.popleft().result()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def search_pages(query: str, chunk: int, jobs: int, start: int = 0,
+                 **kwargs: Any) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Yields pages of the search results starting at `start` as raw JSON. Once
+    the first page tells the total number of issues, the rest of the pages
+    are requested in parallel.
+    """
+    def search(pos: int) -> Any:
+        return jiramail.jserv.jira.search_issues(query, startAt=pos, maxResults=chunk,
+                                                 json_result=True, **kwargs)
+
+    res = search(start)
+    if not res or not isinstance(res, dict):
+        return
+
+    total = int(res.get("total", 0))
+
+    logger.info("query `%s` found %d issues", query, total)
+
+    yield res.get("issues", [])
+
+    for res in fetch_ordered(search, range(start + chunk, total, chunk), jobs):
+        if not res or not isinstance(res, dict):
+            break
+        yield res.get("issues", [])
+
+
+class PageEnd:
+    """
+    Marks the end of a page of search results in the stream of issues. It
+    goes through the pipeline after the issues of the page, so the position
+    is saved only when all of them have been written to the mailbox. The
+    last page of a query shard is marked as done. A marker without a query
+    only commits the issues written to the mailbox.
+    """
+    __slots__ = ("query", "position", "key", "done")
+
+    def __init__(self, query: str, position: int, key: str, done: bool = False):
+        self.query = query
+        self.position = position
+        self.key = key
+        self.done = done
+
+
+def query_pages(query: str, start: int, jobs: int, fields: str) -> Generator[Any, None, None]:
+    position = start
+    for page in search_pages(query, 50, jobs, start, fields=fields, expand="changelog"):
+        yield from page
+        position += len(page)
+        if page:
+            yield PageEnd(query, position, str(page[-1].get("key", "")))
+
+
+def resume_query(query: str, position: int, key: str, jobs: int, fields: str) -> Generator[Any, None, None]:
+    """
+    Continues the query after the `position` issues written to the mailbox.
+    The last of them is requested again to check that its key is still
+    `key`, otherwise the search results have shifted and the query starts
+    over.
+    """
+    pages = query_pages(query, position - 1, jobs, fields)
+    first = next(pages, None)
+
+    if isinstance(first, dict) and first.get("key") == key:
+        logger.info("resuming query `%s` after issue %s", query, key)
+        yield from pages
+        return
+
+    pages.close()
+
+    logger.warning("results of query `%s` have changed since issue %s, starting over", query, key)
+    yield from query_pages(query, 0, jobs, fields)
+
+
+def list_changed_issues(query: str, state: jiramail.state.IssueState, jobs: int) -> List[str]:
+    changed: List[str] = []
+
+    for res in search_pages(query, 100, jobs, fields="updated"):
+        for issue in res:
+            if state.get(str(issue["id"])) != str(issue["fields"].get("updated")):
+                changed.append(str(issue["id"]))
+
+    return changed
+
+
+def fetch_changelog(issue_id: str, pos: int) -> Tuple[List[Dict[str, Any]], int]:
+    try:
+        data = jiramail.jserv.get_json(f"issue/{issue_id}/changelog",
+                                       {"startAt": pos, "maxResults": PAGE_SIZE})
+    except jira.exceptions.JIRAError as e:
+        if e.status_code != 404:
+            raise
+        # Jira Server has no paged changelog resource, but it returns the
+        # whole changelog of a single issue.
+        issue = jiramail.jserv.jira.issue(issue_id, fields="created", expand="changelog")
+        values: List[Dict[str, Any]] = issue.raw["changelog"]["histories"]
+        return values[pos:], len(values)
+
+    return data.get("values", []), int(data.get("total", 0))
+
+
+def fetch_comments(issue_id: str, pos: int) -> Tuple[List[Dict[str, Any]], int]:
+    data = jiramail.jserv.get_json(f"issue/{issue_id}/comment",
+                                   {"startAt": pos, "maxResults": PAGE_SIZE, "orderBy": "created"})
+    return data.get("comments", []), int(data.get("total", 0))
+
+
+def fetch_rest(pool: concurrent.futures.Executor,
+               fetch: Callable[[str, int], Tuple[List[Dict[str, Any]], int]],
+               issue_id: str, start: int = 0) -> Iterator[Dict[str, Any]]:
+    """
+    Starts retrieving the items right away and returns an iterator over
+    them. The next page is requested while the current one is consumed.
+    """
+    first = pool.submit(fetch, issue_id, start)
+
+    def pages(future: Optional[concurrent.futures.Future[Tuple[List[Dict[str, Any]], int]]]) -> Iterator[Dict[str, Any]]:
+        pos = start
+        while future is not None:
+            items, total = future.result()
+            pos += len(items)
+            future = pool.submit(fetch, issue_id, pos) if items and pos < total else None
+            yield from items
+
+    return pages(first)
+
+
+def is_truncated(container: Dict[str, Any], name: str) -> bool:
+    total = container.get("total")
+    return isinstance(total, int) and total > len(container.get(name) or [])
+
+
+def created_key(item: Dict[str, Any]) -> datetime:
+    return datetime.fromisoformat(item["created"])
+
+
+def items_after(container: Dict[str, Any], name: str, pool: concurrent.futures.Executor,
+                fetch: Callable[[str, int], Tuple[List[Dict[str, Any]], int]],
+                issue_id: str, count: int, last_id: str) -> Optional[Iterator[Dict[str, Any]]]:
+    """
+    Returns the iterator over the items that follow the first `count` items
+    of the issue. Only the pages after them are requested. The last of these
+    items is requested again to check that it has not been removed, otherwise
+    None is returned.
+    """
+    if not is_truncated(container, name):
+        items = sorted(container.get(name) or [], key=created_key)
+        if count and (len(items) < count or str(items[count - 1].get("id")) != last_id):
+            return None
+        return iter(items[count:])
+
+    if not count:
+        return fetch_rest(pool, fetch, issue_id)
+
+    items, total = pool.submit(fetch, issue_id, count - 1).result()
+    if not items or str(items[0].get("id")) != last_id:
+        return None
+
+    pos = count - 1 + len(items)
+    rest = fetch_rest(pool, fetch, issue_id, pos) if pos < total else iter([])
+
+    return itertools.chain(items[1:], rest)
+
+
+def complete_issue(raw: Dict[str, Any], pool: concurrent.futures.Executor,
+                   mark: Optional[Dict[str, Any]] = None) -> Tuple[Optional[Iterator[Dict[str, Any]]],
+                                                                   Optional[Iterator[Dict[str, Any]]],
+                                                                   Optional[Dict[str, Any]]]:
+    """
+    Starts retrieving changes and comments that did not fit into the search
+    results. This happens in the background while the issues before this
+    one are rendered. Returns the iterators over all changes and comments
+    of the issue or None if the search results have all of them.
+
+    If the issue has been written to the mailbox before, only the changes
+    and comments after its mark are retrieved and the mark is returned
+    as the point to continue rendering from.
+    """
+    histories = comments = None
+
+    changelog = raw.get("changelog") or {}
+    comment = (raw.get("fields") or {}).get("comment") or {}
+
+    if mark is not None:
+        issue_id = str(raw["id"])
+        n_histories, last_history = mark["history"]
+        n_comments, last_comment = mark["comment"]
+
+        histories = items_after(changelog, "histories", pool, fetch_changelog, issue_id,
+                                int(n_histories), str(last_history))
+        if histories is not None:
+            comments = items_after(comment, "comments", pool, fetch_comments, issue_id,
+                                   int(n_comments), str(last_comment))
+
+        if histories is not None and comments is not None:
+            logger.debug("issue %s is known, retrieving changes after %s and comments after %s ...",
+                         raw["key"], n_histories, n_comments)
+            return histories, comments, mark
+
+        logger.debug("issue %s has removed changes or comments, retrieving all of them ...", raw["key"])
+        histories = comments = None
+
+    if is_truncated(changelog, "histories"):
+        logger.debug("issue %s has %d changes, retrieving all of them ...", raw["key"], changelog["total"])
+        histories = fetch_rest(pool, fetch_changelog, str(raw["id"]))
+
+    if is_truncated(comment, "comments"):
+        logger.debug("issue %s has %d comments, retrieving all of them ...", raw["key"], comment["total"])
+        comments = fetch_rest(pool, fetch_comments, str(raw["id"]))
+
+    return histories, comments, None
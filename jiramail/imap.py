@@ -12,13 +12,17 @@ import os.path
 import re
 import socket
 import socketserver
+import time
 
 from typing import Generator, Callable, Optional, Pattern, Dict, List, Set, Any
 
 import jiramail
 import jiramail.auth as auth
+import jiramail.compact
 import jiramail.imap_proto.parser as imap_proto
 import jiramail.mbox
+import jiramail.pipeline
+import jiramail.render
 import jiramail.subs
 
 CRLF = '\r\n'
@@ -152,6 +156,8 @@ def reset(ctx: Context) -> None:
     ctx["authorized"] = False
     ctx["subscribed"] = set()
     ctx["deleted"] = set()
+    ctx["keys"] = []
+    ctx["ids"] = []
     ctx["select"] = ""
     ctx["tag"] = ""
 
@@ -228,8 +234,7 @@ def send_fetch_resp(ctx: Context,
                     seqs: imap_proto.Node,
                     attrs: imap_proto.Node) -> None:
     for key in sequence(seqs, ctx["mbox"].n_msgs):
-        index = key - 1
-        mail = ctx["mbox"].get_message(index)
+        mail = ctx["mbox"].get_message(ctx["keys"][key - 1])
 
         fields = set()
         resp: CommonResponse
@@ -247,7 +252,7 @@ def send_fetch_resp(ctx: Context,
                     case "FLAGS":
                         # A parenthesized list of flags that are set for this
                         # message.
-                        resp = ListResponse(name, [f"\\{x}" for x in MailFlags(mail.get_flags())])
+                        resp = ListResponse(name, [f"\\{x}" for x in MailFlags(ctx["mbox"].get_flags(ctx["keys"][key - 1]))])
                     case "INTERNALDATE":
                         # A string representing the internal date of the message.
                         continue
@@ -307,10 +312,8 @@ def send_store_resp(ctx: Context, seqs: imap_proto.Node, data: imap_proto.Node)
         return
 
     for seq in sequence(seqs, ctx["mbox"].n_msgs):
-        index = seq - 1
-        mail = ctx["mbox"].get_message(index)
-
-        flags = MailFlags(mail.get_flags())
+        index = ctx["keys"][seq - 1]
+        flags = MailFlags(ctx["mbox"].get_flags(index))
 
         match data["value"]["op"]:
             case "add":
@@ -322,11 +325,10 @@ def send_store_resp(ctx: Context, seqs: imap_proto.Node, data: imap_proto.Node)
 
         if "Deleted" in flags:
             ctx["deleted"] |= set([index])
-        elif seq in ctx["deleted"]:
+        elif index in ctx["deleted"]:
             ctx["deleted"] -= set([index])
 
-        mail.set_flags(str(flags))
-        ctx["mbox"].update_message(index, mail)
+        ctx["mbox"].set_flags(index, str(flags))
 
         if data["value"]["item"] == "FLAGS":
             resp = ListResponse(f"{seq} STORE", [])
@@ -343,15 +345,14 @@ def get_mbox_stats(mbox: jiramail.Mailbox) -> Dict[str,int]:
             "recent": 0,
             }
 
-    for seq in mbox.iterkeys():
-        mail = mbox.get_message(seq)
-        flags = MailFlags(mail.get_flags())
+    for key in mbox.iterkeys():
+        flags = MailFlags(mbox.get_flags(key))
         if "Recent" in flags:
             ret["recent"] += 1
         ret["msgs"] += 1
-        ret["uid_next"] = seq
 
-    ret["uid_next"] += 1
+    # UIDs are the sequence numbers of the messages.
+    ret["uid_next"] = ret["msgs"] + 1
 
     return ret
 
@@ -368,6 +369,40 @@ def send_examine_resp(ctx: Context, mbox: jiramail.Mailbox) -> None:
     ctx.send_result(f"{stats['recent']} RECENT")
 
 
+def update_keys(ctx: Context) -> None:
+    ctx["keys"] = list(ctx["mbox"].iterkeys())
+    ctx["ids"] = [ctx["mbox"].persistent_id(x) for x in ctx["keys"]]
+    ctx["generation"] = ctx["mbox"].generation
+
+
+def send_mbox_updates(ctx: Context) -> None:
+    # Another process could append messages to the selected mailbox or
+    # remove them and rewrite the mailbox. Such changes are also picked up
+    # when the mailbox is written by a command, so the list of messages is
+    # compared with the one known to the client.
+    ctx["mbox"].refresh()
+
+    if ctx["mbox"].generation == ctx["generation"]:
+        return
+
+    old_ids = dict(zip(ctx["keys"], ctx["ids"]))
+    old_seqs = ctx["ids"]
+
+    update_keys(ctx)
+
+    new_keys = dict(zip(ctx["ids"], ctx["keys"]))
+
+    # Sequence numbers are sent from the end, so that each of them is still
+    # valid after the previous messages have been expunged.
+    for seq in range(len(old_seqs), 0, -1):
+        if old_seqs[seq - 1] not in new_keys:
+            ctx.send_result(f"{seq} EXPUNGE")
+
+    ctx["deleted"] = set([new_keys[old_ids[x]] for x in ctx["deleted"] if old_ids.get(x) in new_keys])
+
+    ctx.send_result(f"{len(ctx['keys'])} EXISTS")
+
+
 def send_status_resp(ctx: Context,
                      mbox: jiramail.Mailbox,
                      mailbox: str,
@@ -506,7 +541,7 @@ def command_status(ctx: Context, cmd: imap_proto.Node) -> ImapResponse:
         return ctx.resp_no(f"{cmd['name']} no such mailbox")
 
     try:
-        mbox = jiramail.Mailbox(mailbox)
+        mbox = jiramail.open_mailbox(mailbox, jiramail.subs.get_format(ctx["config"], cmd["value"]["mailbox"]))
     except Exception as e:
         err = f"unable to open mailbox: {e}"
         logger.critical(err)
@@ -527,7 +562,7 @@ def command_examine(ctx: Context, cmd: imap_proto.Node) -> ImapResponse:
         return ctx.resp_no(f"{cmd['name']} no such mailbox")
 
     try:
-        mbox = jiramail.Mailbox(mailbox)
+        mbox = jiramail.open_mailbox(mailbox, jiramail.subs.get_format(ctx["config"], cmd["value"]["mailbox"]))
     except Exception as e:
         err = f"unable to open mailbox: {e}"
         logger.critical(err)
@@ -549,7 +584,7 @@ def command_select(ctx: Context, cmd: imap_proto.Node) -> ImapResponse:
         ctx["mbox"].close()
 
     try:
-        ctx["mbox"] = jiramail.Mailbox(mailbox)
+        ctx["mbox"] = jiramail.open_mailbox(mailbox, jiramail.subs.get_format(ctx["config"], cmd["value"]["mailbox"]))
     except Exception as e:
         err = f"unable to open mailbox: {e}"
         logger.critical(err)
@@ -564,6 +599,7 @@ def command_select(ctx: Context, cmd: imap_proto.Node) -> ImapResponse:
     logger.info("Command SELECT: `%s` synchronization is complete.", cmd["value"]["mailbox"])
     ctx["select"] = cmd["value"]["mailbox"]
     ctx["deleted"] = set()
+    update_keys(ctx)
 
     send_examine_resp(ctx, ctx["mbox"])
 
@@ -626,11 +662,14 @@ def command_store(ctx: Context, cmd: imap_proto.Node) -> ImapResponse:
 
 
 def command_expunge(ctx: Context, cmd: imap_proto.Node) -> ImapResponse:
-    for seq in ctx["deleted"]:
-        ctx["mbox"].del_message(seq)
+    for key in ctx["deleted"]:
+        ctx["mbox"].del_message(key)
 
     ctx["mbox"].sync()
 
+    # The removed messages are reported with the other changes.
+    ctx["deleted"] = set()
+
     return ctx.resp_ok(f"{cmd['name']} completed")
 
 
@@ -724,6 +763,9 @@ class ImapTCPHandler(socketserver.StreamRequestHandler):
                         resp = ctx.resp_no("mailbox not selected")
                     else:
                         resp = commands[cmd["name"]].handler(ctx, cmd)
+
+                    if ctx["select"] != "" and "mbox" in ctx:
+                        send_mbox_updates(ctx)
                 else:
                     resp = ctx.resp_ok("command not recognized")
 
@@ -742,8 +784,32 @@ class ImapServer(socketserver.ForkingTCPServer):
         self.address_family = socket.AF_INET
         self.socket_type = socket.SOCK_STREAM
         self.allow_reuse_address = True
+        self.last_request = time.monotonic()
+        self.compacted = False
         super().__init__(addr, handler)
 
+    def process_request(self, request: Any, client_address: Any) -> None:
+        self.last_request = time.monotonic()
+        self.compacted = False
+        super().process_request(request, client_address)
+
+    def service_actions(self) -> None:
+        super().service_actions()
+
+        # Compact mailboxes when there have been no connections for a while.
+        idle = int(self.config.get("imap", {}).get("compact_idle", 0))
+
+        if idle <= 0 or self.compacted or self.active_children:
+            return
+
+        if time.monotonic() - self.last_request < idle:
+            return
+
+        self.compacted = True
+
+        for mailbox, fmt in jiramail.compact.get_mailboxes(self.config).items():
+            jiramail.compact.compact_mailbox(mailbox, fmt, force=False)
+
 
 # pylint: disable-next=unused-argument
 def main(cmdargs: argparse.Namespace) -> int:
@@ -754,7 +820,10 @@ def main(cmdargs: argparse.Namespace) -> int:
         return jiramail.EX_FAILURE
 
     jiramail.auth.logger = logger
+    jiramail.compact.logger = logger
     jiramail.mbox.logger = logger
+    jiramail.pipeline.logger = logger
+    jiramail.render.logger = logger
     jiramail.subs.logger = logger
 
     saddr = ("localhost", config.get("imap", {}).get("port", 10143))
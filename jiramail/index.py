@@ -0,0 +1,539 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import array
+import bisect
+import contextlib
+import fcntl
+import hashlib
+import itertools
+import mmap
+import os
+import os.path
+import re
+import sys
+import tempfile
+
+from typing import Optional, Dict, List, Set, Tuple, IO, BinaryIO
+from collections.abc import Iterator
+
+INDEX_MAGIC = "jiramail-index"
+INDEX_VERSION = 2
+
+# The number of bytes at the end of the mailbox covered by the checksum.
+TAIL_SIZE = 4096
+
+# Message-Ids generated by jiramail.mbox for issues, changes and comments.
+MSGID_RE = re.compile(r'^<(v?)(0|[1-9][0-9]{0,9})-(0|[1-9][0-9]{0,9})@((?:changes\.|comment\.)?issue)\.jira>$')
+MSGID_KINDS = {
+        ("v", "issue"): 1,
+        ("", "changes.issue"): 2,
+        ("", "comment.issue"): 3,
+        }
+MSGID_NAMES = {kind: name for name, kind in MSGID_KINDS.items()}
+MSGID_LIMIT = 1 << 31
+
+# The number of Message-Ids added since the last merge, after which they are
+# moved into the sorted array.
+MERGE_SIZE = 1024
+
+
+class IndexEntry:
+    """
+    Position of a message in the mailbox file. The Message-Ids generated by
+    jiramail are kept packed into integers, so the entries of a large
+    mailbox do not hold a string for each message.
+    """
+    __slots__ = ("offset", "length", "flags", "ident", "deleted")
+
+    def __init__(self, offset: int, length: int, flags: str, msgid: str,
+                 deleted: bool = False):
+        self.offset = offset
+        self.length = length
+        # Most messages have the same flags.
+        self.flags = sys.intern(flags)
+        value = encode_msgid(msgid)
+        self.ident: int | str = msgid if value is None else value
+        # The message has been removed, but it is still in the mailbox
+        # file until the mailbox is compacted.
+        self.deleted = deleted
+
+    @property
+    def msgid(self) -> str:
+        if isinstance(self.ident, int):
+            return decode_msgid(self.ident)
+        return self.ident
+
+
+def encode_msgid(msgid: Optional[str]) -> Optional[int]:
+    """
+    Packs a Message-Id generated by jiramail into a 64-bit integer. Returns
+    None for any other Message-Id or if the numbers in it are too big.
+    """
+    if not msgid:
+        return None
+
+    m = MSGID_RE.match(msgid)
+    if not m:
+        return None
+
+    kind = MSGID_KINDS.get((m.group(1), m.group(4)))
+    if kind is None:
+        return None
+
+    first, second = int(m.group(2)), int(m.group(3))
+    if first >= MSGID_LIMIT or second >= MSGID_LIMIT:
+        return None
+
+    return first << 33 | second << 2 | kind
+
+
+def decode_msgid(value: int) -> str:
+    prefix, domain = MSGID_NAMES[value & 3]
+    return f"<{prefix}{value >> 33}-{(value >> 2) & (MSGID_LIMIT - 1)}@{domain}.jira>"
+
+
+class MessageIds:
+    """
+    Set of the Message-Ids of a mailbox. The Message-Ids generated by jiramail
+    are packed into integers and kept in a sorted array, so each of them
+    takes 8 bytes instead of a string object and a dict slot. The other
+    Message-Ids are rare and are kept as strings.
+    """
+    __slots__ = ("ids", "added", "other")
+
+    def __init__(self) -> None:
+        self.ids = array.array("Q")
+        self.added: Set[int] = set()
+        self.other: Set[Optional[str]] = set()
+
+    def find(self, value: int) -> int:
+        pos = bisect.bisect_left(self.ids, value)
+        if pos < len(self.ids) and self.ids[pos] == value:
+            return pos
+        return -1
+
+    def merge(self) -> None:
+        self.ids = array.array("Q", sorted(itertools.chain(self.ids, self.added)))
+        self.added = set()
+
+    def add(self, msgid: Optional[str]) -> None:
+        value = encode_msgid(msgid)
+        self.add_packed(msgid if value is None else value)
+
+    def add_packed(self, value: int | str | None) -> None:
+        """
+        Adds a Message-Id packed as in IndexEntry.ident.
+        """
+        if not isinstance(value, int):
+            self.other.add(value)
+            return
+
+        if value in self.added or self.find(value) >= 0:
+            return
+
+        self.added.add(value)
+
+        if len(self.added) >= max(MERGE_SIZE, len(self.ids) // 4):
+            self.merge()
+
+    def discard(self, msgid: Optional[str]) -> None:
+        value = encode_msgid(msgid)
+        if value is None:
+            self.other.discard(msgid)
+            return
+
+        if value in self.added:
+            self.added.discard(value)
+            return
+
+        pos = self.find(value)
+        if pos >= 0:
+            del self.ids[pos]
+
+    def __contains__(self, msgid: Optional[str]) -> bool:
+        value = encode_msgid(msgid)
+        if value is None:
+            return msgid in self.other
+        return value in self.added or self.find(value) >= 0
+
+    def __len__(self) -> int:
+        return len(self.ids) + len(self.added) + len(self.other)
+
+
+def sidecar_path(path: str, suffix: str) -> str:
+    """
+    Returns the path of the hidden file next to the mailbox that keeps some
+    state of it.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, f".{basename}.{suffix}")
+
+
+@contextlib.contextmanager
+def replace_file(path: str, errors: Optional[str] = None) -> Iterator[IO[str]]:
+    """
+    Yields a temporary text file that replaces the file at `path` at once
+    when the block completes, so readers never see a partially written
+    file. The temporary file is removed if the block fails.
+    """
+    dirname, basename = os.path.split(path)
+
+    with tempfile.NamedTemporaryFile("w", dir=dirname, prefix=basename,
+                                     encoding="utf-8", errors=errors,
+                                     delete=False) as fd:
+        try:
+            yield fd
+        except BaseException:
+            os.unlink(fd.name)
+            raise
+
+    os.replace(fd.name, path)
+
+
+def line_field(value: str) -> str:
+    # The Message-Id is a field of a line in the index and the flags files.
+    return value.replace("\t", " ").replace("\n", " ")
+
+
+def tail_checksum(fd: BinaryIO, size: int) -> str:
+    start = max(0, size - TAIL_SIZE)
+    fd.seek(start)
+    return hashlib.sha1(fd.read(size - start)).hexdigest()
+
+
+def scan_headers(fd: BinaryIO, pos: int, names: List[str]) -> Iterator[Tuple[int, int, Dict[str, str]]]:
+    """
+    Yields (start, stop) offsets of the messages in the same way as
+    mailbox.mbox does it, along with the values of the requested headers.
+    The mailbox is mapped into memory and only the header blocks are looked
+    at, so no email.message.Message objects are created.
+    """
+    size = os.fstat(fd.fileno()).st_size
+
+    if size <= pos:
+        return
+
+    header_re = re.compile(rb'^(' + b'|'.join([re.escape(x.encode()) for x in names]) +
+                           rb'):[ \t]*(.*(?:\n[ \t].*)*)', re.I | re.M)
+    lower_names = {x.lower(): x for x in names}
+
+    with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if mm[pos:pos + 5] == b'From ':
+            start = pos
+        else:
+            start = mm.find(b'\nFrom ', pos)
+            if start < 0:
+                return
+            start += 1
+
+        while True:
+            found = mm.find(b'\nFrom ', start)
+
+            if found >= 0:
+                stop = found + 1
+                next_start = found + 1
+            else:
+                stop = size
+                next_start = -1
+
+            # The empty line before the next "From " line is not a part of
+            # the message.
+            if mm[stop - 2:stop] == b'\n\n':
+                stop -= 1
+
+            body = mm.find(b'\n', start, stop) + 1
+            if body == 0:
+                body = stop
+
+            end = mm.find(b'\n\n', body - 1, stop)
+            if end < 0:
+                end = stop
+
+            headers: Dict[str, str] = {}
+
+            for m in header_re.finditer(mm[body:end + 1]):
+                name = lower_names[m.group(1).decode().lower()]
+                if name not in headers:
+                    headers[name] = m.group(2).rstrip(b'\r\n').decode("ascii", "surrogateescape")
+
+            yield (start, stop, headers)
+
+            if next_start < 0:
+                break
+            start = next_start
+
+
+def replace_flags(data: bytes, flags: str) -> bytes:
+    """
+    Replaces the Status and X-Status headers of the message in the mbox
+    format. The rest of the message is left untouched.
+    """
+    body = data.find(b'\n') + 1
+    if body == 0:
+        return data
+
+    end = data.find(b'\n\n', body - 1)
+    if end < 0:
+        end = len(data) - 1
+
+    headers = data[body:end + 1]
+    if headers and not headers.endswith(b'\n'):
+        headers += b'\n'
+
+    headers = re.sub(rb'^(?:status|x-status):.*\n(?:[ \t].*\n)*', b'', headers, flags=re.I | re.M)
+
+    status = "".join([x for x in "RO" if x in flags])
+    xstatus = "".join([x for x in "DFA" if x in flags])
+
+    if status:
+        headers += f"Status: {status}\n".encode()
+    if xstatus:
+        headers += f"X-Status: {xstatus}\n".encode()
+
+    return data[:body] + headers + data[end + 1:]
+
+
+class MailboxLock:
+    """
+    Lock of the mailbox shared by all processes using it. The lock is taken
+    on a separate file because the mailbox file itself is replaced when it is
+    rewritten. Locks can be nested, a shared lock is upgraded if an exclusive
+    one is requested inside it.
+    """
+    def __init__(self, path: str):
+        self.path = sidecar_path(path, "lock")
+        self.fd: Optional[int] = None
+        self.mode = 0
+
+    def open(self) -> Optional[int]:
+        if self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            except OSError:
+                try:
+                    self.fd = os.open(self.path, os.O_RDONLY)
+                except OSError:
+                    # Nothing to lock in a read-only directory.
+                    self.fd = -1
+        return self.fd if self.fd >= 0 else None
+
+    @contextlib.contextmanager
+    def hold(self, mode: int) -> Iterator[None]:
+        prev = self.mode
+        fd = self.open()
+
+        if fd is not None and (prev == 0 or (prev == fcntl.LOCK_SH and mode == fcntl.LOCK_EX)):
+            fcntl.flock(fd, mode)
+            self.mode = mode
+        try:
+            yield
+        finally:
+            if fd is not None and self.mode != prev:
+                fcntl.flock(fd, prev or fcntl.LOCK_UN)
+                self.mode = prev
+
+    def shared(self) -> contextlib.AbstractContextManager[None]:
+        return self.hold(fcntl.LOCK_SH)
+
+    def exclusive(self) -> contextlib.AbstractContextManager[None]:
+        return self.hold(fcntl.LOCK_EX)
+
+    def close(self) -> None:
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+        self.mode = 0
+
+
+class MailboxFlags:
+    """
+    Flags changed since the mailbox was written last time. They are kept in a
+    text file next to the mailbox, so changing flags does not require to
+    rewrite the mailbox. A change appends a line with the Message-Id and the
+    flags, and the later lines override the earlier ones. The flags are
+    moved into the mailbox when it is rewritten.
+
+    Only the lines appended by other processes since the last read are read
+    on refresh. The caller must hold the exclusive lock of the mailbox to
+    change the flags.
+    """
+    def __init__(self, path: str):
+        self.path = sidecar_path(path, "flags")
+        self.flags: Dict[str, str] = {}
+
+        # The file, the number of bytes and lines read from it.
+        self.inode: Tuple[int, int] = (0, 0)
+        self.size = 0
+        self.lines = 0
+
+        # The file ends with a line cut short by an interrupted write.
+        self.broken = False
+
+    def stat(self) -> Tuple[Tuple[int, int], int]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return (0, 0), 0
+        return (st.st_dev, st.st_ino), st.st_size
+
+    def read(self, pos: int) -> None:
+        try:
+            with open(self.path, "rb") as fd:
+                fd.seek(pos)
+                data = fd.read()
+        except FileNotFoundError:
+            return
+
+        end = data.rfind(b"\n") + 1
+
+        for line in data[:end].split(b"\n")[:-1]:
+            msgid, _, flags = line.decode("utf-8", "surrogateescape").rpartition("\t")
+            self.flags[msgid] = flags
+            self.lines += 1
+
+        self.size = pos + end
+        self.broken = end < len(data)
+
+    def load(self) -> None:
+        self.flags = {}
+        self.size = 0
+        self.lines = 0
+        self.broken = False
+        self.inode, size = self.stat()
+
+        if size > 0:
+            self.read(0)
+
+    def refresh(self) -> None:
+        inode, size = self.stat()
+
+        if inode != self.inode or size < self.size:
+            self.load()
+        elif size > self.size:
+            self.read(self.size)
+
+    def get(self, msgid: str, default: str) -> str:
+        return self.flags.get(msgid, default)
+
+    def set(self, msgid: str, flags: str) -> None:
+        self.refresh()
+
+        self.flags[msgid] = flags
+
+        # The old lines are dropped once they outnumber the flags.
+        if self.broken or self.lines >= 2 * len(self.flags) + 1000:
+            self.rewrite()
+            return
+
+        with open(self.path, "ab") as fd:
+            fd.write(f"{line_field(msgid)}\t{flags}\n".encode("utf-8", "surrogateescape"))
+
+        self.lines += 1
+        self.inode, self.size = self.stat()
+
+    def rewrite(self) -> None:
+        with replace_file(self.path, errors="surrogateescape") as fd:
+            for msgid, flags in self.flags.items():
+                fd.write(f"{line_field(msgid)}\t{flags}\n")
+
+        self.lines = len(self.flags)
+        self.broken = False
+        self.inode, self.size = self.stat()
+
+    def clear(self) -> None:
+        if not self.flags and self.stat()[1] == 0:
+            return
+
+        self.flags = {}
+        self.rewrite()
+
+
+class MailboxIndex:
+    def __init__(self, path: str):
+        self.path = sidecar_path(path, "index")
+        self.entries: List[IndexEntry] = []
+        self.size = 0
+        self.mtime = 0
+        self.checksum = ""
+
+    def mtime_ns(self) -> int:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return 0
+
+    def deleted(self) -> Set[str]:
+        """
+        Returns Message-Ids of the removed messages which have no other copy
+        in the mailbox.
+        """
+        deleted = set([x.msgid for x in self.entries if x.deleted and x.msgid])
+        deleted -= set([x.msgid for x in self.entries if not x.deleted])
+        return deleted
+
+    def stamp(self, fd: BinaryIO) -> None:
+        st = os.fstat(fd.fileno())
+
+        self.size = st.st_size
+        self.mtime = st.st_mtime_ns
+        self.checksum = tail_checksum(fd, st.st_size)
+
+    def is_valid(self, fd: BinaryIO) -> bool:
+        st = os.fstat(fd.fileno())
+
+        if st.st_size != self.size or st.st_mtime_ns != self.mtime:
+            return False
+
+        return tail_checksum(fd, self.size) == self.checksum
+
+    def has_grown(self, fd: BinaryIO) -> bool:
+        """
+        Checks that the mailbox has only been appended since the index was
+        written. The old part of the mailbox should end where the "From "
+        line of the next message starts.
+        """
+        st = os.fstat(fd.fileno())
+
+        if st.st_size <= self.size:
+            return False
+
+        if tail_checksum(fd, self.size) != self.checksum:
+            return False
+
+        return fd.read(5) == b'From '
+
+    def load(self) -> bool:
+        try:
+            with open(self.path, "r", encoding="utf-8", errors="surrogateescape") as fd:
+                header = fd.readline().split()
+
+                if len(header) != 5 or header[0] != INDEX_MAGIC or header[1] != str(INDEX_VERSION):
+                    return False
+
+                self.size = int(header[2])
+                self.mtime = int(header[3])
+                self.checksum = header[4]
+
+                entries: List[IndexEntry] = []
+
+                for line in fd:
+                    offset, length, deleted, flags, msgid = line[:-1].split("\t", 4)
+                    entries.append(IndexEntry(int(offset), int(length), flags, msgid,
+                                              deleted == "1"))
+
+        except (OSError, ValueError):
+            return False
+
+        self.entries = entries
+        return True
+
+    def save(self) -> None:
+        with replace_file(self.path, errors="surrogateescape") as fd:
+            fd.write(f"{INDEX_MAGIC} {INDEX_VERSION} {self.size} {self.mtime} {self.checksum}\n")
+
+            for entry in self.entries:
+                fd.write(f"{entry.offset}\t{entry.length}\t{int(entry.deleted)}\t{entry.flags}\t{line_field(entry.msgid)}\n")
@@ -39,7 +39,7 @@ def main(cmdargs: argparse.Namespace) -> int:
         return jiramail.EX_FAILURE
 
     try:
-        jiramail.jserv = jiramail.Connection(config.get("jira", {}))
+        jiramail.jserv = jiramail.Connection(config.get("jira", {}), cmdargs.refresh_meta)
     except Exception as e:
         logger.critical("unable to connect to jira: %s", e)
         return jiramail.EX_FAILURE
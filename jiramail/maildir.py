@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import email
+import email.message
+import email.parser
+import mailbox
+import os
+import os.path
+
+from typing import Dict, List, Tuple, Any
+from collections.abc import Iterator
+
+import jiramail
+
+logger = jiramail.logger
+
+
+def maildir_flags(subdir: str, info: str) -> str:
+    # The same conversion that mailbox.mboxMessage does for MaildirMessage.
+    flags = ""
+    if info.startswith("2,"):
+        info = info[2:]
+    if "S" in info: flags += "R" # pylint: disable=multiple-statements
+    if subdir == "cur": flags += "O" # pylint: disable=multiple-statements
+    if "T" in info: flags += "D" # pylint: disable=multiple-statements
+    if "F" in info: flags += "F" # pylint: disable=multiple-statements
+    if "R" in info: flags += "A" # pylint: disable=multiple-statements
+    return flags
+
+
+def mh_flags(sequences: Dict[str, Any]) -> Dict[int, str]:
+    # The same conversion that mailbox.mboxMessage does for MHMessage.
+    flags: Dict[int, str] = {}
+    for key in sequences.get("unseen", []):
+        flags[key] = "O"
+    for key in sequences.get("flagged", []):
+        flags[key] = flags.get(key, "RO") + "F"
+    for key in sequences.get("replied", []):
+        flags[key] = flags.get(key, "RO") + "A"
+    return flags
+
+
+class MaildirMailbox(jiramail.Mailbox):
+    """
+    Every message is stored in a separate file, so appending, changing the
+    flags and removing a message do not touch the other messages.
+    """
+    mbox: mailbox.Maildir | mailbox.MH
+
+    def __init__(self, path: str, fmt: str):
+        super().__init__(path)
+
+        # (flags, Message-Id) of each message.
+        self.info: Dict[Any, Tuple[str, str]] = {}
+
+        match fmt:
+            case "maildir":
+                self.mbox = mailbox.Maildir(self.path, factory=None, create=True)
+            case "mh":
+                self.mbox = mailbox.MH(self.path, factory=None, create=True)
+            case _:
+                raise ValueError(f"unknown mailbox format: {fmt}")
+
+        self.fmt = fmt
+        self.scan()
+
+        logger.info("mailbox is ready")
+
+    def scan(self) -> bool:
+        present = set(self.mbox.iterkeys())
+
+        # Messages removed by other processes.
+        removed = [x for x in self.info if x not in present]
+
+        for key in removed:
+            _, msg_id = self.info.pop(key)
+            self.msgid.discard(msg_id)
+            self.n_msgs -= 1
+
+        keys: List[Any] = sorted([x for x in present if x not in self.info])
+
+        if not keys and not removed:
+            return False
+
+        flags: Dict[Any, str] = {}
+
+        if keys and isinstance(self.mbox, mailbox.MH):
+            flags = mh_flags(self.mbox.get_sequences())
+        elif keys:
+            flags = self.scan_maildir()
+
+        for key in keys:
+            msg_id = self.read_msgid(key)
+            self.info[key] = (flags.get(key, "RO"), msg_id)
+            if msg_id:
+                self.msgid.add(msg_id)
+            self.n_msgs += 1
+
+        self.generation += 1
+        return True
+
+    def scan_maildir(self) -> Dict[Any, str]:
+        flags: Dict[Any, str] = {}
+        colon = getattr(self.mbox, "colon", ":")
+
+        for subdir in ("new", "cur"):
+            for name in os.listdir(os.path.join(self.path, subdir)):
+                if name.startswith("."):
+                    continue
+                key, _, info = name.partition(colon)
+                flags[key] = maildir_flags(subdir, info)
+
+        return flags
+
+    def read_msgid(self, key: Any) -> str:
+        lines = []
+
+        with self.mbox.get_file(key) as fd:
+            for line in fd:
+                if line in (b"\n", b"\r\n"):
+                    break
+                lines.append(line)
+
+        headers = email.parser.BytesHeaderParser().parsebytes(b"".join(lines))
+        return str(headers.get("Message-Id", ""))
+
+    def convert(self, mail: email.message.Message) -> mailbox.Message:
+        if not isinstance(mail, mailbox.Message):
+            # Flags of a plain message are in the Status and X-Status headers.
+            mail = mailbox.mboxMessage(mail)
+        if self.fmt == "mh":
+            return mailbox.MHMessage(mail)
+        return mailbox.MaildirMessage(mail)
+
+    def get_message(self, key: Any) -> mailbox.mboxMessage:
+        return mailbox.mboxMessage(self.mbox.get_message(key))
+
+    def get_flags(self, key: Any) -> str:
+        return self.info[key][0]
+
+    def del_message(self, key: Any) -> None:
+        self.mbox.remove(key)
+
+        _, msg_id = self.info.pop(key)
+        self.msgid.discard(msg_id)
+        self.n_msgs -= 1
+        self.generation += 1
+
+    def update_message(self, key: Any, mail: email.message.Message) -> None:
+        self.mbox[key] = self.convert(mail)
+        self.info[key] = (jiramail.mail_flags(mail), self.info[key][1])
+
+    def add_message(self, mail: email.message.Message) -> None:
+        key = self.mbox.add(self.convert(mail))
+        self.info[key] = (jiramail.mail_flags(mail), str(mail.get("Message-Id", "")))
+
+    def iterkeys(self) -> Iterator[Any]:
+        return iter(list(self.info.keys()))
+
+    def refresh(self) -> bool:
+        # Messages are added to the directory atomically by renaming, so no
+        # locking is needed to pick them up.
+        return self.scan()
+
+    def sync(self) -> None:
+        self.mbox.flush()
+
+    def close(self) -> None:
+        self.mbox.close()
@@ -5,521 +5,147 @@
 __author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
 
 import argparse
-import collections
-import difflib
-import email
-import email.utils
-import re
 
-from datetime import datetime
-from datetime import timedelta
+from typing import Optional, List, Set, Any
 
-from typing import Optional, Dict, List, Sequence, Union, Any
-
-from collections.abc import Iterator, Iterable
-
-import tabulate
-
-import jira
-import jira.resources
+from collections.abc import Iterator
 
 import jiramail
+import jiramail.fetch
+import jiramail.pipeline
+import jiramail.render
+import jiramail.shard
+import jiramail.state
 
 logger = jiramail.logger
 
 
-class Subject:
-    def __init__(self, key: str, text: str) -> None:
-        self.version = 1
-        self.key = key
-        self.text = text
-        self.action = ""
-
-    def __str__(self) -> str:
-        subj = [f"[{self.key}]"]
-        if self.action:
-            subj.append(self.action)
-        if self.text:
-            subj.append(self.text)
-        return " ".join(subj)
-
-
-class User:
-    def __init__(self, user: Any):
-        self.name = ""
-        self.addr = "unknown"
-
-        if isinstance(user, jira.resources.UnknownResource) or \
-                isinstance(user, jira.resources.User):
-            self.from_resource(user)
-
-    def __str__(self) -> str:
-        return email.utils.formataddr((self.name, self.addr), charset='utf-8')
-
-    def to_string(self) -> str:
-        return str(self)
-
-    def from_resource(self, user: Union[jira.resources.UnknownResource,
-                                        jira.resources.User]) -> None:
-        if hasattr(user, "displayName"):
-            self.name = user.displayName
-        if hasattr(user, "emailAddress"):
-            self.addr = user.emailAddress
-
-
-class PropertyItem:
-    def __init__(self, item: jira.resources.PropertyHolder):
-        self.field = getattr(item, "field", "") or ""
-        self.fieldtype = getattr(item, "fieldtype", "") or ""
-        self.fromString = getattr(item, "fromString", "") or ""
-        self.toString = getattr(item, "toString", "") or ""
-
-    def is_field_change(self) -> bool:
-        return self.field != "" and self.fieldtype != ""
-
-
-class Property:
-    def __init__(self, prop: jira.resources.PropertyHolder):
-        self.id = getattr(prop, "id", "") or ""
-        self.created = getattr(prop, "created", "") or ""
-        self.author = User(getattr(prop, "author", {}) or {})
-        self.items: List[PropertyItem] = []
-
-        for it in getattr(prop, "items", []) or []:
-            item = PropertyItem(it)
-            if item.is_field_change():
-                self.items.append(item)
-
-    def is_valid(self) -> bool:
-        return self.author.addr != "unknown" and self.created != "" and len(self.items) > 0
-
-
-def chain(*iterables: Iterable[Any]) -> Iterator[Any]:
-    for it in iterables:
-        for element in it:
-            yield element
-
-
-def has_attrs(o: object, attrs: List[str]) -> bool:
-    for attr in attrs:
-        if not hasattr(o, attr):
-            return False
-    return True
-
-
-def make_list(s: str, delim: str) -> Iterator[str]:
-    return map(lambda b: f'"{b.strip()}"', re.split(delim, s))
-
-
-def get_issue_field(issue: jira.resources.Issue, name: str) -> Optional[Any]:
-    try:
-        return issue.get_field(field_name=name)
-    except AttributeError:
-        pass
-    field = jiramail.jserv.field_by_name(name.lower(), {})
-    if field:
-        try:
-            return issue.get_field(field["id"])
-        except AttributeError:
-            pass
-    return None
-
-
-def get_date(data: str) -> str:
-    dt = datetime.fromisoformat(data)
-    return email.utils.format_datetime(dt)
-
-
-def get_issue_info(issue: jira.resources.Issue,
-                   items: List[Dict[str, Any]]) -> List[List[str]]:
-    ret = []
-    for item in items:
-        field = jiramail.jserv.field_by_name(item['name'], {})
-        value = get_issue_field(issue, item['name'])
-        if value:
-            ret.append([field['name'], item['getter'](value)])
-    return ret
-
-
-def decode_markdown(message: str) -> List[str]:
-    body = []
-    links = []
-
-    def repl_link(m: re.Match[str]) -> str:
-        links.append(m.group(2))
-        return f"\"{m.group(1)}\"[{len(links)}]"
-
-    def repl_quote(m: re.Match[str]) -> str:
-        return "\n" + "\n".join([f"> {x}" for x in m.group(1).splitlines()]) + "\n"
-
-    def repl_code(m: re.Match[str]) -> str:
-        return "\n" + "\n".join([f"| {x}" for x in m.group(1).splitlines()]) + "\n"
-
-    def repl_noformat(m: re.Match[str]) -> str:
-        return m.group(1)
-
-    message = re.sub(r'\[([^|]+)\|([^\]]+)\]', repl_link, message)
-    message = re.sub(r'{{(.*?)}}', r"\1", message)
-    message = re.sub(r'{quote}(.*?){quote}', repl_quote, message, flags=re.M | re.S)
-    message = re.sub(r'{code:[^}]*}\s*(.*?){code}', repl_code, message, flags=re.M | re.S)
-    message = re.sub(r'{noformat}(.*?){noformat}', repl_noformat, message, flags=re.M | re.S)
+def get_fields(names: Optional[List[str]] = None) -> str:
+    """
+    Returns the list of field ids to request from jira. Custom fields are
+    known to the rendering code by their names, so they are translated to
+    the ids.
+    """
+    if names is None:
+        names = jiramail.render.RENDER_FIELDS
 
-    body.append(message)
+    ids: List[str] = []
 
-    if links:
-        body.append("")
-        for i, link in enumerate(links):
-            body.append(f"[{i+1}] {link}")
+    # The value of `updated` is kept in the state of issues.
+    for name in names + ["updated"]:
+        if name.startswith("*"):
+            return name
+        field_id = str(jiramail.jserv.field_by_name(name.lower(), {}).get("id", name))
+        if field_id not in ids:
+            ids.append(field_id)
 
-    return body
+    return ",".join(ids)
 
 
-def get_table(data: List[List[Any]],
-              headers: Sequence[str] = (),
-              colalign: Optional[List[Optional[str]]] = None,
-              maxcolwidths: Optional[List[int]] = None) -> str:
-    return tabulate.tabulate(data, tablefmt="presto", disable_numparse=True,
-                             headers=headers, colalign=colalign, maxcolwidths=maxcolwidths)
+def parse_fields(value: str) -> Optional[List[str]]:
+    names = [x.strip() for x in value.split(",") if x.strip()]
+    return names or None
 
 
-def issue_email(issue: jira.resources.Issue, date: str, author: User,
-                subject: Subject, message: str) -> email.message.EmailMessage:
-    mail = email.message.EmailMessage()
-
-    msg_id = f"<v{subject.version}-{issue.id}@issue.jira>"
-
-    mail.add_header("Date", get_date(date))
-    mail.add_header("From", str(author))
-    mail.add_header("Message-Id", msg_id)
-    mail.add_header("Reply-To", "change@jira")
-    mail.add_header("X-Jiramail-Issue-Id", f"{issue.id}")
-    mail.add_header("X-Jiramail-Issue-Key", f"{issue.key}")
-
-    if subject.version > 1:
-        parent_id = f"<v1-{issue.id}@issue.jira>"
-
-        mail.add_header("In-Reply-To", parent_id)
-        mail.add_header("References", f"{parent_id} {msg_id}")
-
-        subject.action = "U:"
-    else:
-        subject.action = ""
-
-    mail.add_header("Subject", str(subject))
-
-    body = []
-
-    info = get_issue_info(issue, [
-        {"name": "issuetype", "getter": lambda a: f'"{a.name}"'},
-        {"name": "severity",  "getter": lambda a: f'"{a.value}"'},
-        {"name": "priority",  "getter": lambda a: f'"{a.name}"'},
-        {"name": "labels",    "getter": lambda a: ", ".join(map(lambda b: f'"{b}"', a))},
-        {"name": "keywords",  "getter": lambda a: ", ".join(map(lambda b: f'"{b}"', a))},
-        ])
-    if info:
-        body.append(get_table(info,
-                              colalign=["right", "left"],
-                              maxcolwidths=[40, 60]))
-        body.append("---")
-        body.append("")
-
-    body += decode_markdown(message)
-
-    body.append("")
-    body.append("-- ")
-    body.append(issue.permalink()) # type: ignore
-    body.append("")
-
-    mail.set_content("\n".join(body))
-
-    return mail
-
-
-def changes_email(issue: jira.resources.Issue, change_id: str, date: str,
-                  author: User,
-                  subject: Subject,
-                  changes: List[PropertyItem]) -> email.message.EmailMessage:
-    mail = email.message.EmailMessage()
-
-    msg_id = f"<{issue.id}-{change_id}@changes.issue.jira>"
-    parent_id = f"<v1-{issue.id}@issue.jira>"
-    subject.action = "U:"
-    status = ""
-
-    mail.add_header("Date", get_date(date))
-    mail.add_header("From", str(author))
-    mail.add_header("Message-Id", msg_id)
-    mail.add_header("Reply-To", "change@jira")
-    mail.add_header("In-Reply-To", parent_id)
-    mail.add_header("References", f"{parent_id} {msg_id}")
-    mail.add_header("X-Jiramail-Issue-Id", f"{issue.id}")
-    mail.add_header("X-Jiramail-Issue-Key", f"{issue.key}")
-
-    textarea: Dict[str, PropertyItem] = collections.OrderedDict()
-    table = []
-
-    for item in changes:
-        if item.fieldtype == "jira" and item.field == "status" and item.toString:
-            status = f" [{item.toString}]"
-
-        meta = jiramail.jserv.field_by_name(item.field.lower(), {})
-        normalized = False
-
-        if "schema" in meta:
-            match meta["schema"]["type"]:
-                case "array":
-                    match meta["schema"]["items"]:
-                        case "option" | "user":
-                            delim = r','
-                        case "component":
-                            delim = ""
-                        case _:
-                            delim = r'\s+'
-
-                    if delim:
-                        item.fromString = ", ".join(sorted(make_list(item.fromString, delim)))
-                        item.toString   = ", ".join(sorted(make_list(item.toString, delim)))
-                        normalized = True
-
-                case "string":
-                    if "custom" in meta["schema"] and meta["schema"]["custom"].endswith(":textarea"):
-                        if item.field in textarea:
-                            textarea[item.field].toString = item.toString
-                        else:
-                            textarea[item.field] = item
-                        continue
-
-        if not normalized:
-            item.fromString = f"\"{item.fromString}\""
-            item.toString = f"\"{item.toString}\""
-
-        table.append([meta.get("name", item.field), item.fromString, item.toString])
-
-    body = []
-
-    if table:
-        body.append(get_table(table,
-                              headers=["What","Removed", "Added"],
-                              colalign=["right", "left", "left"],
-                              maxcolwidths=[40, 60, 60]))
-        if textarea:
-            body.append("---")
-
-    for item in textarea.values():
-        header = f"JIRA FIELD: {item.field}"
-        if item.fromString:
-            header += " (diff attached)"
-        body.append(f"[-- {header} --]")
-        body.append(item.toString)
-        body.append("")
-
-    body.append("-- ")
-    body.append("")
-
-    mail.add_header("Subject", str(subject) + status)
-    mail.set_content("\n".join(body))
-
-    for item in textarea.values():
-        if item.fromString:
-            attach_diff(mail, item, f"{item.field}.diff")
-
-    return mail
-
-
-def comment_email(issue: jira.resources.Issue, comment: jira.resources.Comment,
-                  date: str, author: User, subject: Subject, message: str) -> email.message.EmailMessage:
-    mail = email.message.EmailMessage()
-
-    msg_id = f"<{issue.id}-{comment.id}@comment.issue.jira>"
-    parent_id = f"<v1-{issue.id}@issue.jira>"
-    subject.action = "C:"
-    cc_header = []
-    reply_to_header = [("Add a comment", "comment@jira")]
-
-    mail.add_header("Subject", str(subject))
-    mail.add_header("Date", get_date(date))
-    mail.add_header("From", str(author))
-    mail.add_header("Message-Id", msg_id)
-    mail.add_header("In-Reply-To", parent_id)
-    mail.add_header("References", f"{parent_id} {msg_id}")
-    mail.add_header("X-Jiramail-Issue-Id", f"{issue.id}")
-    mail.add_header("X-Jiramail-Issue-Key", f"{issue.key}")
-
-    if hasattr(comment, "visibility") and hasattr(comment.visibility, "value"):
-        cc_header.append((f"{comment.visibility.value}",
-                          f"{comment.visibility.type}@visible.comment.jira"))
-
-    if cc_header:
-        mail.add_header("Cc", ", ".join([ email.utils.formataddr(x) for x in cc_header ]))
-
-    mail.add_header("Reply-To", ", ".join([ email.utils.formataddr(x) for x in reply_to_header ]))
-
-    body = []
-
-    body += decode_markdown(message)
-
-    body.append("")
-    body.append("-- ")
-    body.append("{url}?focusedId={commentid}#comment-{commentid}".format(
-        url=issue.permalink(), # type: ignore
-        commentid=comment.id))
-    body.append("")
-
-    mail.set_content("\n".join(body))
-
-    return mail
-
-
-def attach_diff(mail: email.message.EmailMessage,
-                item: PropertyItem,
-                filename: str) -> None:
-    diff = difflib.ndiff(item.fromString.splitlines(keepends=True),
-                         item.toString.splitlines(keepends=True))
-
-    max_context = 3
-    changes = []
-
-    context: collections.deque[str] = collections.deque(maxlen=max_context)
-    context_after: bool = False
+def process_changed(query: str, pipeline: jiramail.pipeline.Pipeline, state: jiramail.state.IssueState,
+                    jobs: int, fields: str) -> None:
+    """
+    Lists the issues of the query with the `updated` field only and then
+    retrieves new and changed issues in full.
+    """
+    chunk = 50
+    changed = []
 
-    for line in diff:
-        if not line.startswith(" "):
-            while len(context) > 0:
-                changes.append(context.popleft())
-            changes.append(line)
-            context_after = True
+    for issue_id in jiramail.fetch.list_changed_issues(query, state, jobs):
+        if issue_id in pipeline.seen:
+            state.set(issue_id, pipeline.seen[issue_id])
         else:
-            if context_after and len(context) == max_context:
-                while len(context) > 0:
-                    changes.append(context.popleft())
-                context_after = False
-            context.append(line)
-
-    while context_after and len(context) > 0:
-        changes.append(context.popleft())
-
-    mail.add_attachment("".join(changes).encode(),
-                        filename=filename,
-                        maintype="text", subtype="x-diff")
-
-
-def add_issue(issue: jira.resources.Issue, mbox: jiramail.Mailbox) -> None:
-    logger.debug("processing issue %s ...", issue.key)
-    # pprint.pprint(issue.raw)
-
-    date = str(get_issue_field(issue, "created"))
-    summary = str(get_issue_field(issue, "summary"))
-    description = str(get_issue_field(issue, "description"))
-
-    history: Optional[Property] = None
-    changes: List[PropertyItem] = []
-
-    subject = Subject(issue.key, summary)
-
-    for el in sorted(
-            chain(issue.changelog.histories, issue.fields.comment.comments),
-            key=lambda x: datetime.fromisoformat(x.created),
-            reverse=False):
-
-        if isinstance(el, jira.resources.PropertyHolder):
-            prop = Property(el)
-
-            if not prop.is_valid():
-                continue
+            changed.append(issue_id)
 
-            if history:
-                t1 = datetime.fromisoformat(history.created)
-            else:
-                t1 = datetime.fromisoformat("1970-01-01T00:00:01.000+0000")
-            t2 = datetime.fromisoformat(prop.created)
+    logger.info("query `%s` has %d new or changed issues", query, len(changed))
 
-            if changes and history and (
-                    prop.author.addr != history.author.addr or
-                    (t2 - t1) >= timedelta(hours=1)):
-                mail = changes_email(issue, history.id, history.created,
-                                     history.author, subject, changes)
-                mbox.append(mail)
-                changes = []
+    def search(ids: List[str]) -> Any:
+        return jiramail.jserv.jira.search_issues(f"id in ({','.join(ids)})",
+                                                 fields=fields,
+                                                 expand="changelog",
+                                                 maxResults=len(ids),
+                                                 json_result=True)
 
-            for item in prop.items:
-                if item.fieldtype == "jira" and item.field == "description":
-                    if changes:
-                        mail = changes_email(issue, prop.id + "-0",
-                                             prop.created, prop.author,
-                                             subject, changes)
-                        mbox.append(mail)
-                        changes = []
+    def fetch() -> Iterator[Any]:
+        for res in jiramail.fetch.fetch_ordered(search, [changed[i:i + chunk] for i in range(0, len(changed), chunk)], jobs):
+            if res and isinstance(res, dict):
+                yield from res.get("issues", [])
+            # The state of the issues written so far is saved, so they are
+            # skipped if the run is interrupted.
+            yield jiramail.fetch.PageEnd("", 0, "")
 
-                    mail = issue_email(issue, date, prop.author, subject,
-                                       item.fromString or "")
-                    attach_diff(mail, item, "description.diff")
-                    mbox.append(mail)
+    pipeline.run(fetch(), state)
 
-                    date = prop.created
-                    subject.version += 1
-                    continue
 
-                if item.fieldtype == "jira" and item.field == "Comment":
-                    continue
-
-                if item.fieldtype == "jira" and item.field == "summary":
-                    subject.text = item.toString
-
-                if item.fromString or item.toString:
-                    changes.append(item)
-
-            history = prop
-            continue
-
-        if isinstance(el, jira.resources.Comment):
-            if not has_attrs(el, ["id", "created", "author", "body"]):
-                # Something strange with this object
-                continue
+def process_query(query: str, mbox: jiramail.Mailbox | jiramail.pipeline.Pipeline,
+                  state: Optional[jiramail.state.IssueState] = None, jobs: int = 1,
+                  fields: Optional[List[str]] = None) -> None:
+    logger.debug("processing query `%s` ...", query)
 
-            mail = comment_email(issue, el, el.created, User(el.author),
-                                 subject, el.body)
-            mbox.append(mail)
-            continue
+    if isinstance(mbox, jiramail.pipeline.Pipeline):
+        pipeline = mbox
+    else:
+        pipeline = jiramail.pipeline.Pipeline(mbox, jobs=jobs)
 
-        logger.critical("unknown history item: %s", repr(el))
+    checkpoint = pipeline.checkpoint
+    field_ids = get_fields(fields)
 
-    if history and changes:
-        mail = changes_email(issue, history.id, history.created,
-                             history.author, subject, changes)
-        mbox.append(mail)
+    if checkpoint is not None and checkpoint.is_done(query):
+        logger.info("query `%s` has been completed before, skipping", query)
+        return
 
-    history = None
-    changes = []
+    start = checkpoint.resume_at(query) if checkpoint is not None else None
 
-    mail = issue_email(issue, date, User(issue.fields.reporter), subject,
-                       description or "")
-    mail.add_header("To", User(issue.fields.assignee).to_string())
-    mbox.append(mail)
+    if state is not None:
+        process_changed(query, pipeline, state, jobs, field_ids)
+    elif pipeline.shard_size > 0:
+        shards = jiramail.shard.query_shards(query, pipeline.shard_field, pipeline.shard_size, jobs, checkpoint)
+        pipeline.run(jiramail.shard.shard_issues(shards, jobs, field_ids, checkpoint))
+    elif start is not None:
+        pipeline.run(jiramail.fetch.resume_query(query, start[0], start[1], jobs, field_ids))
+    else:
+        pipeline.run(jiramail.fetch.query_pages(query, 0, jobs, field_ids))
 
+    if checkpoint is not None:
+        checkpoint.finish(query)
 
-def process_query(query: str, mbox: jiramail.Mailbox) -> None:
-    pos = 0
-    chunk = 50
 
-    logger.debug("processing query `%s` ...", query)
+def process_issues(keys: List[str], pipeline: jiramail.pipeline.Pipeline, chunk: int, jobs: int,
+                   fields: Optional[List[str]] = None) -> List[str]:
+    """
+    Retrieves the issues by their keys with `key in (...)` searches of up to
+    `chunk` keys. Returns the keys of the issues that were not found because
+    they do not exist or are not visible to the user.
+    """
+    keys = list(dict.fromkeys(keys))
+    field_ids = get_fields(fields)
+    found: Set[str] = set()
 
-    while True:
-        res = jiramail.jserv.jira.search_issues(query,
-                                       expand="changelog",
-                                       startAt=pos,
-                                       maxResults=chunk)
-        if not res or not isinstance(res, jira.client.ResultList):
-            break
+    def search(part: List[str]) -> Any:
+        # Without validation, jira does not reject the whole search because
+        # of an unknown key.
+        return jiramail.jserv.jira.search_issues(f"key in ({','.join(part)})",
+                                                 fields=field_ids,
+                                                 expand="changelog",
+                                                 maxResults=len(part),
+                                                 validate_query=False,
+                                                 json_result=True)
 
-        if pos == 0:
-            logger.info("query `%s` found %d issues", query, res.total)
+    def fetch() -> Iterator[Any]:
+        for res in jiramail.fetch.fetch_ordered(search, [keys[i:i + chunk] for i in range(0, len(keys), chunk)], jobs):
+            if res and isinstance(res, dict):
+                for issue in res.get("issues", []):
+                    found.update([str(issue.get("key", "")).upper(), str(issue.get("id", ""))])
+                    yield issue
 
-        for issue in res:
-            add_issue(issue, mbox)
+    pipeline.run(fetch())
 
-        if res.isLast:
-            break
-        pos += chunk
+    return [key for key in keys if key.upper() not in found]
 
 
 def main(cmdargs: argparse.Namespace) -> int:
@@ -530,27 +156,60 @@ def main(cmdargs: argparse.Namespace) -> int:
         return jiramail.EX_FAILURE
 
     try:
-        mbox = jiramail.Mailbox(cmdargs.mailbox)
+        mbox = jiramail.open_mailbox(cmdargs.mailbox)
     except Exception as e:
         logger.critical("unable to open mailbox: %s", e)
         return jiramail.EX_FAILURE
 
     try:
-        jiramail.jserv = jiramail.Connection(config.get("jira", {}))
+        jiramail.jserv = jiramail.Connection(config.get("jira", {}), cmdargs.refresh_meta)
     except Exception as e:
         logger.critical("unable to connect to jira: %s", e)
         return jiramail.EX_FAILURE
 
-    for username in cmdargs.assignee:
-        process_query(f"assignee = '{username}'", mbox)
+    state = None
+    missing: List[str] = []
 
-    for query in cmdargs.queries:
-        process_query(query, mbox)
+    if cmdargs.only_changed:
+        state = jiramail.state.IssueState(mbox.path)
+        if mbox.n_msgs > 0:
+            state.load()
 
-    for key in cmdargs.issues:
-        issue = jiramail.jserv.jira.issue(key, expand="changelog")
-        add_issue(issue, mbox)
+    pipeline = jiramail.pipeline.Pipeline(mbox, cmdargs.procs, cmdargs.jobs)
+    pipeline.shard_size = max(0, cmdargs.shard_size)
+    pipeline.shard_field = cmdargs.shard_field
+    fields = parse_fields(cmdargs.fields)
+
+    pipeline.marks = jiramail.state.IssueMarks(mbox.path)
+    if mbox.n_msgs > 0 and not cmdargs.full:
+        pipeline.marks.load()
+
+    pipeline.checkpoint = jiramail.state.Checkpoint(mbox.path)
+    if cmdargs.resume:
+        pipeline.checkpoint.load()
+
+    with mbox.batch(max(1, cmdargs.batch_size)):
+        for username in cmdargs.assignee:
+            process_query(f"assignee = '{username}'", pipeline, state, cmdargs.jobs, fields)
+
+        for query in cmdargs.queries:
+            process_query(query, pipeline, state, cmdargs.jobs, fields)
+
+        if cmdargs.issues:
+            missing = process_issues(cmdargs.issues, pipeline, max(1, cmdargs.issue_batch),
+                                     cmdargs.jobs, fields)
+
+    if state is not None:
+        state.save()
+
+    pipeline.marks.save()
+    pipeline.checkpoint.remove()
 
     mbox.close()
+    jiramail.jserv.report()
+
+    if missing:
+        logger.critical("issues not found or not accessible: %s", ", ".join(missing))
+        return jiramail.EX_FAILURE
 
     return jiramail.EX_SUCCESS
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import concurrent.futures
+import multiprocessing
+import queue
+import threading
+
+from typing import Optional, Dict, Any
+
+from collections.abc import Iterator
+
+import jiramail
+import jiramail.fetch
+import jiramail.render
+import jiramail.state
+
+logger = jiramail.logger
+
+# The number of issues waiting between the stages of the pipeline.
+PIPELINE_SIZE = 64
+
+
+class Pipeline:
+    """
+    Issues go through three stages that run at the same time: they are
+    received from jira, rendered into emails and written to the mailbox.
+    The stages are connected by bounded queues, so a stage waits when the
+    next one falls behind. Emails can be rendered in a process pool, so that
+    large changelogs do not hold the GIL of the writer.
+
+    The same pipeline is used for all queries to the mailbox in a run, so an
+    issue found by several queries is retrieved in full and rendered once.
+    """
+    def __init__(self, mbox: jiramail.Mailbox, procs: int = 0, jobs: int = 1):
+        self.mbox = mbox
+        self.procs = procs
+        self.jobs = jobs
+        self.stop = threading.Event()
+
+        # The `updated` field of the issues written to the mailbox.
+        self.seen: Dict[str, str] = {}
+
+        # The progress of queries to resume the run after a failure.
+        self.checkpoint: Optional[jiramail.state.Checkpoint] = None
+
+        # The changes and comments of issues written to the mailbox.
+        self.marks: Optional[jiramail.state.IssueMarks] = None
+
+        # Queries with more issues are split into shards by the date field.
+        self.shard_size = 0
+        self.shard_field = "created"
+
+    def put(self, q: queue.Queue[Any], item: Any) -> bool:
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q: queue.Queue[Any]) -> Any:
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def receive(self, issues: Iterator[Any], received: queue.Queue[Any],
+                pages: concurrent.futures.Executor) -> None:
+        try:
+            for raw in issues:
+                if isinstance(raw, jiramail.fetch.PageEnd):
+                    if not self.put(received, raw):
+                        return
+                    continue
+
+                issue = jiramail.render.RawIssue(raw)
+
+                if issue.id in self.seen:
+                    logger.debug("issue %s has already been processed", issue.key)
+                    continue
+
+                mark = self.marks.get(issue.id) if self.marks is not None else None
+
+                issue.histories, issue.comments, issue.start = jiramail.fetch.complete_issue(raw, pages, mark)
+
+                if not self.put(received, issue):
+                    return
+            self.put(received, None)
+        except BaseException as e:
+            self.put(received, e)
+        finally:
+            getattr(issues, "close", lambda: None)()
+
+    def render(self, received: queue.Queue[Any], rendered: queue.Queue[Any],
+               pool: Optional[concurrent.futures.Executor]) -> None:
+        while True:
+            issue = self.get(received)
+
+            if issue is None or isinstance(issue, BaseException):
+                self.put(rendered, issue)
+                return
+
+            if isinstance(issue, jiramail.fetch.PageEnd):
+                if not self.put(rendered, issue):
+                    return
+                continue
+
+            result: Any
+
+            try:
+                if pool is not None:
+                    result = pool.submit(jiramail.render.render_raw, issue.to_raw(), issue.start)
+                else:
+                    result = (jiramail.render.render_issue(issue), issue.mark)
+            except BaseException as e:
+                self.put(rendered, e)
+                return
+
+            if not self.put(rendered, (issue, result)):
+                return
+
+    def open_pool(self) -> Optional[concurrent.futures.Executor]:
+        if self.procs <= 0:
+            return None
+
+        if multiprocessing.current_process().daemon:
+            logger.warning("unable to render emails in a process pool from a daemon process")
+            return None
+
+        # Workers should not request the field metadata over the connection
+        # inherited from this process.
+        jiramail.jserv.fill_fields()
+
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.procs,
+                                                      mp_context=multiprocessing.get_context("fork"))
+
+    def commit(self, page: jiramail.fetch.PageEnd, state: Optional[jiramail.state.IssueState]) -> None:
+        self.mbox.flush()
+
+        if state is not None:
+            state.save()
+
+        if self.marks is not None:
+            self.marks.save()
+
+        if self.checkpoint is None or not page.query:
+            return
+
+        if page.done:
+            self.checkpoint.finish(page.query)
+        else:
+            self.checkpoint.update(page.query, page.position, page.key)
+
+    def run(self, issues: Iterator[Any], state: Optional[jiramail.state.IssueState] = None) -> None:
+        received: queue.Queue[Any] = queue.Queue(PIPELINE_SIZE)
+        rendered: queue.Queue[Any] = queue.Queue(PIPELINE_SIZE)
+
+        pool = self.open_pool()
+        pages = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.jobs))
+        self.stop.clear()
+
+        threads = [
+                threading.Thread(target=self.receive, args=(issues, received, pages), daemon=True),
+                threading.Thread(target=self.render, args=(received, rendered, pool), daemon=True),
+                ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                item = rendered.get()
+
+                if item is None:
+                    break
+
+                if isinstance(item, BaseException):
+                    raise item
+
+                if isinstance(item, jiramail.fetch.PageEnd):
+                    self.commit(item, state)
+                    continue
+
+                issue, result = item
+
+                if isinstance(result, concurrent.futures.Future):
+                    result = result.result()
+
+                mails, mark = result
+
+                for mail in mails:
+                    self.mbox.append(mail)
+
+                if self.marks is not None:
+                    self.marks.set(issue.id, mark)
+
+                self.seen[issue.id] = str(jiramail.render.get_issue_field(issue, "updated"))
+
+                if state is not None:
+                    state.set(issue.id, self.seen[issue.id])
+        finally:
+            self.stop.set()
+
+            for thread in threads:
+                thread.join()
+
+            if pool is not None:
+                pool.shutdown(wait=True, cancel_futures=True)
+
+            pages.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import collections
+import difflib
+import email
+import email.utils
+import heapq
+import re
+
+from datetime import datetime
+from datetime import timedelta
+
+from typing import Optional, Dict, List, Tuple, Sequence, Any
+
+from collections.abc import Iterator, Iterable
+
+import tabulate
+
+import jiramail
+import jiramail.fetch
+import jiramail.state
+
+logger = jiramail.logger
+
+# Fields shown in the table at the top of the issue email.
+ISSUE_INFO: List[Dict[str, Any]] = [
+        {"name": "issuetype", "getter": lambda a: f'"{a["name"]}"'},
+        {"name": "severity",  "getter": lambda a: f'"{a["value"]}"'},
+        {"name": "priority",  "getter": lambda a: f'"{a["name"]}"'},
+        {"name": "labels",    "getter": lambda a: ", ".join(map(lambda b: f'"{b}"', a))},
+        {"name": "keywords",  "getter": lambda a: ", ".join(map(lambda b: f'"{b}"', a))},
+        ]
+
+# Fields used to render the emails of an issue. The history of changes is
+# requested separately with expand=changelog.
+RENDER_FIELDS = [
+        "summary", "description", "created", "updated",
+        "reporter", "assignee", "comment",
+        ] + [x["name"] for x in ISSUE_INFO]
+
+
+class Subject:
+    def __init__(self, key: str, text: str) -> None:
+        self.version = 1
+        self.key = key
+        self.text = text
+        self.action = ""
+
+    def __str__(self) -> str:
+        subj = [f"[{self.key}]"]
+        if self.action:
+            subj.append(self.action)
+        if self.text:
+            subj.append(self.text)
+        return " ".join(subj)
+
+
+class User:
+    __slots__ = ("name", "addr")
+
+    def __init__(self, user: Any):
+        self.name = ""
+        self.addr = "unknown"
+
+        if isinstance(user, dict):
+            self.from_raw(user)
+
+    def __str__(self) -> str:
+        return email.utils.formataddr((self.name, self.addr), charset='utf-8')
+
+    def to_string(self) -> str:
+        return str(self)
+
+    def from_raw(self, user: Dict[str, Any]) -> None:
+        if "displayName" in user:
+            self.name = user["displayName"]
+        if "emailAddress" in user:
+            self.addr = user["emailAddress"]
+
+
+class PropertyItem:
+    __slots__ = ("field", "fieldtype", "fromString", "toString")
+
+    def __init__(self, item: Dict[str, Any]):
+        self.field = item.get("field") or ""
+        self.fieldtype = item.get("fieldtype") or ""
+        self.fromString = item.get("fromString") or ""
+        self.toString = item.get("toString") or ""
+
+    def is_field_change(self) -> bool:
+        return self.field != "" and self.fieldtype != ""
+
+
+class Property:
+    __slots__ = ("id", "created", "author", "items")
+
+    def __init__(self, prop: Dict[str, Any]):
+        self.id = prop.get("id") or ""
+        self.created = prop.get("created") or ""
+        self.author = User(prop.get("author") or {})
+        self.items: List[PropertyItem] = []
+
+        for it in prop.get("items") or []:
+            item = PropertyItem(it)
+            if item.is_field_change():
+                self.items.append(item)
+
+    def is_valid(self) -> bool:
+        return self.author.addr != "unknown" and self.created != "" and len(self.items) > 0
+
+
+class Comment:
+    __slots__ = ("id", "created", "author", "body", "visibility", "valid")
+
+    def __init__(self, comment: Dict[str, Any]):
+        self.id = comment.get("id") or ""
+        self.created = comment.get("created") or ""
+        self.author = User(comment.get("author"))
+        self.body = comment.get("body") or ""
+        self.visibility: Dict[str, Any] = comment.get("visibility") or {}
+        self.valid = all(x in comment for x in ("id", "created", "author", "body"))
+
+    def is_valid(self) -> bool:
+        return self.valid
+
+
+class RawIssue:
+    """
+    The issue as it is returned by jira. The fields are kept as JSON and
+    changes and comments are turned into the small records above only when
+    the emails are rendered, which is much cheaper than building the
+    jira.resources objects for the whole issue.
+    """
+    __slots__ = ("raw", "id", "key", "fields", "histories", "comments", "start", "mark")
+
+    def __init__(self, raw: Dict[str, Any]):
+        self.raw = raw
+        self.id = str(raw.get("id", ""))
+        self.key = str(raw.get("key", ""))
+        self.fields: Dict[str, Any] = raw.get("fields") or {}
+
+        # All changes and comments of the issue, if they did not fit into the
+        # search results.
+        self.histories: Optional[Iterator[Dict[str, Any]]] = None
+        self.comments: Optional[Iterator[Dict[str, Any]]] = None
+
+        # The mark of the issue to continue rendering from and the mark of
+        # the rendered issue.
+        self.start: Optional[Dict[str, Any]] = None
+        self.mark: Dict[str, Any] = {}
+
+    def permalink(self) -> str:
+        return f"{jiramail.jserv.jira.server_url}/browse/{self.key}"
+
+    def to_raw(self) -> Dict[str, Any]:
+        # The worker process can not use the iterators of the issue.
+        raw = dict(self.raw)
+
+        if self.histories is not None:
+            raw["changelog"] = dict(raw.get("changelog") or {}, histories=list(self.histories))
+
+        if self.comments is not None:
+            fields = dict(self.fields)
+            fields["comment"] = dict(fields.get("comment") or {}, comments=list(self.comments))
+            raw["fields"] = fields
+
+        return raw
+
+
+def make_list(s: str, delim: str) -> Iterator[str]:
+    return map(lambda b: f'"{b.strip()}"', re.split(delim, s))
+
+
+def get_issue_field(issue: RawIssue, name: str) -> Optional[Any]:
+    if name in issue.fields:
+        return issue.fields[name]
+    field = jiramail.jserv.field_by_name(name.lower(), {})
+    if field:
+        return issue.fields.get(field["id"])
+    return None
+
+
+def get_date(data: str) -> str:
+    dt = datetime.fromisoformat(data)
+    return email.utils.format_datetime(dt)
+
+
+def get_issue_info(issue: RawIssue,
+                   items: List[Dict[str, Any]]) -> List[List[str]]:
+    ret = []
+    for item in items:
+        field = jiramail.jserv.field_by_name(item['name'], {})
+        value = get_issue_field(issue, item['name'])
+        if value:
+            ret.append([field['name'], item['getter'](value)])
+    return ret
+
+
+def decode_markdown(message: str) -> List[str]:
+    body = []
+    links = []
+
+    def repl_link(m: re.Match[str]) -> str:
+        links.append(m.group(2))
+        return f"\"{m.group(1)}\"[{len(links)}]"
+
+    def repl_quote(m: re.Match[str]) -> str:
+        return "\n" + "\n".join([f"> {x}" for x in m.group(1).splitlines()]) + "\n"
+
+    def repl_code(m: re.Match[str]) -> str:
+        return "\n" + "\n".join([f"| {x}" for x in m.group(1).splitlines()]) + "\n"
+
+    def repl_noformat(m: re.Match[str]) -> str:
+        return m.group(1)
+
+    message = re.sub(r'\[([^|]+)\|([^\]]+)\]', repl_link, message)
+    message = re.sub(r'{{(.*?)}}', r"\1", message)
+    message = re.sub(r'{quote}(.*?){quote}', repl_quote, message, flags=re.M | re.S)
+    message = re.sub(r'{code:[^}]*}\s*(.*?){code}', repl_code, message, flags=re.M | re.S)
+    message = re.sub(r'{noformat}(.*?){noformat}', repl_noformat, message, flags=re.M | re.S)
+
+    body.append(message)
+
+    if links:
+        body.append("")
+        for i, link in enumerate(links):
+            body.append(f"[{i+1}] {link}")
+
+    return body
+
+
+def get_table(data: List[List[Any]],
+              headers: Sequence[str] = (),
+              colalign: Optional[List[Optional[str]]] = None,
+              maxcolwidths: Optional[List[int]] = None) -> str:
+    return tabulate.tabulate(data, tablefmt="presto", disable_numparse=True,
+                             headers=headers, colalign=colalign, maxcolwidths=maxcolwidths)
+
+
+def issue_email(issue: RawIssue, date: str, author: User,
+                subject: Subject, message: str) -> email.message.EmailMessage:
+    mail = email.message.EmailMessage()
+
+    msg_id = f"<v{subject.version}-{issue.id}@issue.jira>"
+
+    mail.add_header("Date", get_date(date))
+    mail.add_header("From", str(author))
+    mail.add_header("Message-Id", msg_id)
+    mail.add_header("Reply-To", "change@jira")
+    mail.add_header("X-Jiramail-Issue-Id", f"{issue.id}")
+    mail.add_header("X-Jiramail-Issue-Key", f"{issue.key}")
+
+    if subject.version > 1:
+        parent_id = f"<v1-{issue.id}@issue.jira>"
+
+        mail.add_header("In-Reply-To", parent_id)
+        mail.add_header("References", f"{parent_id} {msg_id}")
+
+        subject.action = "U:"
+    else:
+        subject.action = ""
+
+    mail.add_header("Subject", str(subject))
+
+    body = []
+
+    info = get_issue_info(issue, ISSUE_INFO)
+    if info:
+        body.append(get_table(info,
+                              colalign=["right", "left"],
+                              maxcolwidths=[40, 60]))
+        body.append("---")
+        body.append("")
+
+    body += decode_markdown(message)
+
+    body.append("")
+    body.append("-- ")
+    body.append(issue.permalink())
+    body.append("")
+
+    mail.set_content("\n".join(body))
+
+    return mail
+
+
+def changes_email(issue: RawIssue, change_id: str, date: str,
+                  author: User,
+                  subject: Subject,
+                  changes: List[PropertyItem]) -> email.message.EmailMessage:
+    mail = email.message.EmailMessage()
+
+    msg_id = f"<{issue.id}-{change_id}@changes.issue.jira>"
+    parent_id = f"<v1-{issue.id}@issue.jira>"
+    subject.action = "U:"
+    status = ""
+
+    mail.add_header("Date", get_date(date))
+    mail.add_header("From", str(author))
+    mail.add_header("Message-Id", msg_id)
+    mail.add_header("Reply-To", "change@jira")
+    mail.add_header("In-Reply-To", parent_id)
+    mail.add_header("References", f"{parent_id} {msg_id}")
+    mail.add_header("X-Jiramail-Issue-Id", f"{issue.id}")
+    mail.add_header("X-Jiramail-Issue-Key", f"{issue.key}")
+
+    textarea: Dict[str, PropertyItem] = collections.OrderedDict()
+    table = []
+
+    for item in changes:
+        if item.fieldtype == "jira" and item.field == "status" and item.toString:
+            status = f" [{item.toString}]"
+
+        meta = jiramail.jserv.field_by_name(item.field.lower(), {})
+        normalized = False
+
+        if "schema" in meta:
+            match meta["schema"]["type"]:
+                case "array":
+                    match meta["schema"]["items"]:
+                        case "option" | "user":
+                            delim = r','
+                        case "component":
+                            delim = ""
+                        case _:
+                            delim = r'\s+'
+
+                    if delim:
+                        item.fromString = ", ".join(sorted(make_list(item.fromString, delim)))
+                        item.toString   = ", ".join(sorted(make_list(item.toString, delim)))
+                        normalized = True
+
+                case "string":
+                    if "custom" in meta["schema"] and meta["schema"]["custom"].endswith(":textarea"):
+                        if item.field in textarea:
+                            textarea[item.field].toString = item.toString
+                        else:
+                            textarea[item.field] = item
+                        continue
+
+        if not normalized:
+            item.fromString = f"\"{item.fromString}\""
+            item.toString = f"\"{item.toString}\""
+
+        table.append([meta.get("name", item.field), item.fromString, item.toString])
+
+    body = []
+
+    if table:
+        body.append(get_table(table,
+                              headers=["What","Removed", "Added"],
+                              colalign=["right", "left", "left"],
+                              maxcolwidths=[40, 60, 60]))
+        if textarea:
+            body.append("---")
+
+    for item in textarea.values():
+        header = f"JIRA FIELD: {item.field}"
+        if item.fromString:
+            header += " (diff attached)"
+        body.append(f"[-- {header} --]")
+        body.append(item.toString)
+        body.append("")
+
+    body.append("-- ")
+    body.append("")
+
+    mail.add_header("Subject", str(subject) + status)
+    mail.set_content("\n".join(body))
+
+    for item in textarea.values():
+        if item.fromString:
+            attach_diff(mail, item, f"{item.field}.diff")
+
+    return mail
+
+
+def comment_email(issue: RawIssue, comment: Comment,
+                  date: str, author: User, subject: Subject, message: str) -> email.message.EmailMessage:
+    mail = email.message.EmailMessage()
+
+    msg_id = f"<{issue.id}-{comment.id}@comment.issue.jira>"
+    parent_id = f"<v1-{issue.id}@issue.jira>"
+    subject.action = "C:"
+    cc_header = []
+    reply_to_header = [("Add a comment", "comment@jira")]
+
+    mail.add_header("Subject", str(subject))
+    mail.add_header("Date", get_date(date))
+    mail.add_header("From", str(author))
+    mail.add_header("Message-Id", msg_id)
+    mail.add_header("In-Reply-To", parent_id)
+    mail.add_header("References", f"{parent_id} {msg_id}")
+    mail.add_header("X-Jiramail-Issue-Id", f"{issue.id}")
+    mail.add_header("X-Jiramail-Issue-Key", f"{issue.key}")
+
+    if "value" in comment.visibility:
+        cc_header.append((f"{comment.visibility['value']}",
+                          f"{comment.visibility.get('type')}@visible.comment.jira"))
+
+    if cc_header:
+        mail.add_header("Cc", ", ".join([ email.utils.formataddr(x) for x in cc_header ]))
+
+    mail.add_header("Reply-To", ", ".join([ email.utils.formataddr(x) for x in reply_to_header ]))
+
+    body = []
+
+    body += decode_markdown(message)
+
+    body.append("")
+    body.append("-- ")
+    body.append("{url}?focusedId={commentid}#comment-{commentid}".format(
+        url=issue.permalink(),
+        commentid=comment.id))
+    body.append("")
+
+    mail.set_content("\n".join(body))
+
+    return mail
+
+
+def attach_diff(mail: email.message.EmailMessage,
+                item: PropertyItem,
+                filename: str) -> None:
+    diff = difflib.ndiff(item.fromString.splitlines(keepends=True),
+                         item.toString.splitlines(keepends=True))
+
+    max_context = 3
+    changes = []
+
+    context: collections.deque[str] = collections.deque(maxlen=max_context)
+    context_after: bool = False
+
+    for line in diff:
+        if not line.startswith(" "):
+            while len(context) > 0:
+                changes.append(context.popleft())
+            changes.append(line)
+            context_after = True
+        else:
+            if context_after and len(context) == max_context:
+                while len(context) > 0:
+                    changes.append(context.popleft())
+                context_after = False
+            context.append(line)
+
+    while context_after and len(context) > 0:
+        changes.append(context.popleft())
+
+    mail.add_attachment("".join(changes).encode(),
+                        filename=filename,
+                        maintype="text", subtype="x-diff")
+
+
+def issue_events(issue: RawIssue) -> Iterator[Property | Comment]:
+    """
+    Yields changes and comments of the issue in chronological order. If
+    the search results were truncated, the full lists are streamed from the
+    paged resources, so they are merged instead of being sorted.
+    """
+    histories: Iterable[Dict[str, Any]]
+    comments: Iterable[Dict[str, Any]]
+
+    if issue.histories is not None:
+        histories = issue.histories
+    else:
+        histories = sorted((issue.raw.get("changelog") or {}).get("histories") or [], key=jiramail.fetch.created_key)
+
+    if issue.comments is not None:
+        comments = issue.comments
+    else:
+        comments = sorted((issue.fields.get("comment") or {}).get("comments") or [], key=jiramail.fetch.created_key)
+
+    events: Iterator[Property | Comment] = heapq.merge(map(Property, histories),
+                                                       map(Comment, comments),
+                                                       key=lambda x: datetime.fromisoformat(x.created))
+    return events
+
+
+def render_issue(issue: RawIssue) -> List[email.message.EmailMessage]:
+    logger.debug("processing issue %s ...", issue.key)
+    # pprint.pprint(issue.raw)
+
+    mails: List[email.message.EmailMessage] = []
+
+    start = issue.start or {}
+
+    date = str(start.get("date") or get_issue_field(issue, "created"))
+    summary = str(get_issue_field(issue, "summary"))
+    description = str(get_issue_field(issue, "description"))
+
+    history: Optional[Property] = None
+    changes: List[PropertyItem] = []
+
+    # The summary is shown as it was at the time of each change.
+    summary_text: Optional[str] = start.get("summary")
+
+    subject = Subject(issue.key, summary if summary_text is None else summary_text)
+    subject.version = int(start.get("version", 1))
+
+    n_histories, last_history = start.get("history", [0, ""])
+    n_comments, last_comment = start.get("comment", [0, ""])
+
+    mark: Dict[str, Any] = {}
+
+    for el in issue_events(issue):
+
+        if isinstance(el, Property):
+            prop = el
+
+            before = jiramail.state.issue_mark(n_histories, last_history, subject.version, date, summary_text)
+
+            n_histories += 1
+            last_history = prop.id
+
+            if not prop.is_valid():
+                continue
+
+            if history:
+                t1 = datetime.fromisoformat(history.created)
+            else:
+                t1 = datetime.fromisoformat("1970-01-01T00:00:01.000+0000")
+            t2 = datetime.fromisoformat(prop.created)
+
+            if changes and history and (
+                    prop.author.addr != history.author.addr or
+                    (t2 - t1) >= timedelta(hours=1)):
+                mail = changes_email(issue, history.id, history.created,
+                                     history.author, subject, changes)
+                mails.append(mail)
+                changes = []
+
+            for item in prop.items:
+                if item.fieldtype == "jira" and item.field == "description":
+                    if changes:
+                        mail = changes_email(issue, prop.id + "-0",
+                                             prop.created, prop.author,
+                                             subject, changes)
+                        mails.append(mail)
+                        changes = []
+
+                    mail = issue_email(issue, date, prop.author, subject,
+                                       item.fromString or "")
+                    attach_diff(mail, item, "description.diff")
+                    mails.append(mail)
+
+                    date = prop.created
+                    subject.version += 1
+                    continue
+
+                if item.fieldtype == "jira" and item.field == "Comment":
+                    continue
+
+                if item.fieldtype == "jira" and item.field == "summary":
+                    subject.text = summary_text = item.toString
+
+                if item.fromString or item.toString:
+                    if not changes:
+                        # The changes are grouped into one email, so the next
+                        # run continues from the first change of the group.
+                        mark = before
+                    changes.append(item)
+
+            history = prop
+            continue
+
+        n_comments += 1
+        last_comment = el.id
+
+        if not el.is_valid():
+            # Something strange with this object
+            continue
+
+        mail = comment_email(issue, el, el.created, el.author,
+                             subject, el.body)
+        mails.append(mail)
+
+    if history and changes:
+        mail = changes_email(issue, history.id, history.created,
+                             history.author, subject, changes)
+        mails.append(mail)
+    else:
+        mark = jiramail.state.issue_mark(n_histories, last_history, subject.version, date, summary_text)
+
+    history = None
+    changes = []
+
+    mail = issue_email(issue, date, User(issue.fields.get("reporter")), subject,
+                       description or "")
+    mail.add_header("To", User(issue.fields.get("assignee")).to_string())
+    mails.append(mail)
+
+    mark["comment"] = [n_comments, last_comment]
+    issue.mark = mark
+
+    return mails
+
+
+def render_raw(raw: Dict[str, Any], start: Optional[Dict[str, Any]]) -> Tuple[List[email.message.EmailMessage],
+                                                                             Dict[str, Any]]:
+    # Runs in a worker process, which has the connection of the parent
+    # process with the cached field metadata.
+    issue = RawIssue(raw)
+    issue.start = start
+    return render_issue(issue), issue.mark
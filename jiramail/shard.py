@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import queue
+import re
+import threading
+import time
+import zoneinfo
+
+from datetime import datetime, timedelta, timezone, tzinfo
+
+from typing import Optional, List, Tuple, Any
+
+from collections.abc import Iterator, Generator
+
+import jira.exceptions
+
+import jiramail
+import jiramail.fetch
+import jiramail.state
+
+logger = jiramail.logger
+
+# The fields by which a query can be split into shards.
+SHARD_FIELDS = ("created", "updated")
+
+# JQL dates have minute precision, so a shard is not split further.
+MIN_SPAN = timedelta(minutes=1)
+
+# The number of times a shard is requested again after a failure.
+SHARD_RETRIES = 3
+
+# The number of issues of the shards waiting to be processed.
+SHARD_QUEUE = 256
+
+
+class Shard:
+    """
+    Issues of the query with the date field in [start, end). The first and
+    the last shards are open, so the shards cover the issues created or
+    updated while the query is processed.
+    """
+    __slots__ = ("start", "end", "count")
+
+    def __init__(self, start: Optional[datetime], end: Optional[datetime], count: int = 0):
+        self.start = start
+        self.end = end
+        self.count = count
+
+
+def split_order(query: str) -> Tuple[str, str]:
+    m = re.search(r'(^|\s+)ORDER\s+BY\s.*$', query, flags=re.IGNORECASE | re.DOTALL)
+    if not m:
+        return query.strip(), ""
+    return query[:m.start()].strip(), m.group(0).strip()
+
+
+def where(query: str, cond: str) -> str:
+    if not query:
+        return cond
+    if not cond:
+        return query
+    return f"({query}) AND {cond}"
+
+
+def jql_date(value: datetime) -> str:
+    return value.strftime("%Y/%m/%d %H:%M")
+
+
+def shard_query(query: str, field: str, shard: Shard) -> str:
+    base, order = split_order(query)
+
+    conds = []
+    if shard.start is not None:
+        conds.append(f"{field} >= '{jql_date(shard.start)}'")
+    if shard.end is not None:
+        conds.append(f"{field} < '{jql_date(shard.end)}'")
+
+    # The order of issues must be stable to page through the shard.
+    return f"{where(base, ' AND '.join(conds))} {order or f'ORDER BY {field} ASC, key ASC'}"
+
+
+def count_issues(query: str) -> int:
+    data = jiramail.jserv.get_json("search", {"jql": query, "maxResults": 0, "fields": "id"})
+    return int(data.get("total", 0))
+
+
+def user_timezone() -> tzinfo:
+    # JQL dates are in the timezone of the jira user.
+    try:
+        return zoneinfo.ZoneInfo(str(jiramail.jserv.jira.myself().get("timeZone")))
+    except (jira.exceptions.JIRAError, zoneinfo.ZoneInfoNotFoundError, ValueError):
+        return timezone.utc
+
+
+def edge_date(query: str, field: str, direction: str, tz: tzinfo) -> Optional[datetime]:
+    data = jiramail.jserv.get_json("search", {"jql": f"{query} ORDER BY {field} {direction}",
+                                              "maxResults": 1, "fields": field})
+    issues = data.get("issues") or []
+    if not issues:
+        return None
+
+    value = datetime.fromisoformat(str(issues[0]["fields"][field])).astimezone(tz)
+    return value.replace(tzinfo=None, second=0, microsecond=0)
+
+
+def plan_shards(query: str, field: str, size: int, jobs: int) -> List[str]:
+    """
+    Splits the query into disjoint ranges of the date field with no more than
+    `size` issues each, so that no shard is paged through deeply. The ranges
+    are halved until the number of issues in them, requested with
+    maxResults=0, is small enough. Returns the queries of the shards or the
+    query itself if it does not need to be split.
+    """
+    base, _ = split_order(query)
+
+    total = count_issues(where(base, ""))
+    if total <= size:
+        return [query]
+
+    tz = user_timezone()
+
+    first = edge_date(base, field, "ASC", tz)
+    last = edge_date(base, field, "DESC", tz)
+
+    if first is None or last is None:
+        return [query]
+
+    lower, upper = first, last + MIN_SPAN
+
+    shards: List[Shard] = []
+    pending = [Shard(None, None, total)]
+
+    while pending:
+        parts: List[Shard] = []
+
+        for shard in pending:
+            start = shard.start or lower
+            end = shard.end or upper
+
+            if shard.count <= size or end - start <= MIN_SPAN:
+                if shard.count > 0 or shard.start is None or shard.end is None:
+                    shards.append(shard)
+                continue
+
+            middle = start + (end - start) / 2
+            middle = middle.replace(second=0, microsecond=0)
+
+            parts.append(Shard(shard.start, middle))
+            parts.append(Shard(middle, shard.end))
+
+        counts = jiramail.fetch.fetch_ordered(lambda x: count_issues(shard_query(base, field, x)), parts, jobs)
+
+        for shard, count in zip(parts, counts):
+            shard.count = count
+
+        pending = parts
+
+    shards.sort(key=lambda x: x.start or lower)
+
+    logger.info("query `%s` is split into %d shards by `%s'", query, len(shards), field)
+
+    return [shard_query(query, field, shard) for shard in shards]
+
+
+def query_shards(query: str, field: str, size: int, jobs: int,
+                 checkpoint: Optional[jiramail.state.Checkpoint]) -> List[str]:
+    """
+    Returns the shards planned for the query by the interrupted run, since
+    the boundaries of a new plan move as issues are added. Otherwise plans
+    the shards and records them in the checkpoint.
+    """
+    if checkpoint is not None:
+        shards = checkpoint.planned(query)
+        if shards:
+            logger.info("query `%s` is split into %d shards planned before", query, len(shards))
+            return shards
+
+    shards = plan_shards(query, field, size, jobs)
+
+    if checkpoint is not None:
+        checkpoint.plan(query, shards)
+
+    return shards
+
+
+def shard_pages(query: str, jobs: int, fields: str, position: int = 0,
+                key: str = "") -> Generator[Any, None, None]:
+    """
+    Yields the issues of the shard page by page, each page followed by a
+    marker. If a request fails, the shard is requested again after the last
+    yielded page without affecting the other shards.
+    """
+    attempt = 0
+
+    while True:
+        if position > 0 and key:
+            pages = jiramail.fetch.resume_query(query, position, key, jobs, fields)
+        else:
+            pages = jiramail.fetch.query_pages(query, 0, jobs, fields)
+
+        try:
+            for item in pages:
+                if isinstance(item, jiramail.fetch.PageEnd):
+                    position, key = item.position, item.key
+                    attempt = 0
+                yield item
+            break
+        except Exception as e:
+            if attempt == SHARD_RETRIES:
+                raise
+            logger.warning("unable to retrieve shard `%s`: %s, retrying ...", query, e)
+            time.sleep(2 ** attempt)
+            attempt += 1
+        finally:
+            pages.close()
+
+    yield jiramail.fetch.PageEnd(query, position, key, True)
+
+
+def shard_issues(shards: List[str], jobs: int, fields: str,
+                 checkpoint: Optional[jiramail.state.Checkpoint]) -> Iterator[Any]:
+    """
+    Pages through up to `jobs` shards at the same time and yields their
+    issues as they arrive. The pages of each shard keep their order and are
+    followed by their markers, so the progress of each shard is saved on its
+    own. A resumed run skips the shards that have been written to the
+    mailbox and continues the others after their last saved page.
+    """
+    pending = [x for x in shards if checkpoint is None or not checkpoint.is_done(x)]
+
+    if len(pending) < len(shards):
+        logger.info("skipping %d shards completed before", len(shards) - len(pending))
+
+    if not pending:
+        return
+
+    workers = max(1, min(jobs, len(pending)))
+
+    # The rest of the jobs request the pages of the shards in parallel.
+    page_jobs = max(1, jobs // workers)
+
+    items: queue.Queue[Any] = queue.Queue(SHARD_QUEUE)
+    queries = iter(pending)
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker() -> None:
+        try:
+            while True:
+                with lock:
+                    query = next(queries, None)
+
+                if query is None:
+                    break
+
+                start = checkpoint.resume_at(query) if checkpoint is not None else None
+
+                if start is not None:
+                    pages = shard_pages(query, page_jobs, fields, start[0], start[1])
+                else:
+                    pages = shard_pages(query, page_jobs, fields)
+
+                try:
+                    for item in pages:
+                        if not put(item):
+                            return
+                finally:
+                    pages.close()
+        except Exception as e:
+            put(e)
+        finally:
+            put(None)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while workers > 0:
+            item = items.get()
+
+            if item is None:
+                workers -= 1
+                continue
+
+            if isinstance(item, Exception):
+                raise item
+
+            yield item
+    finally:
+        stop.set()
+
+        for thread in threads:
+            thread.join()
@@ -293,7 +293,7 @@ def main(cmdargs: argparse.Namespace) -> int:
 
     if cmdargs.mailbox != "":
         try:
-            state["mbox"] = jiramail.Mailbox(cmdargs.mailbox)
+            state["mbox"] = jiramail.open_mailbox(cmdargs.mailbox)
         except Exception as e:
             logger.critical("unable to open mailbox: %s", e)
             return jiramail.EX_FAILURE
@@ -314,7 +314,7 @@ def main(cmdargs: argparse.Namespace) -> int:
     logger.info("listening on %s", state["saddr"])
 
     try:
-        jiramail.jserv = jiramail.Connection(config.get("jira", {}))
+        jiramail.jserv = jiramail.Connection(config.get("jira", {}), cmdargs.refresh_meta)
     except Exception as e:
         logger.critical("unable to connect to jira: %s", e)
         return jiramail.EX_FAILURE
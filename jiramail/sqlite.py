@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import contextlib
+import email
+import email.generator
+import email.message
+import email.utils
+import io
+import mailbox
+import sqlite3
+import time
+
+from typing import Optional, Any
+from collections.abc import Iterator
+
+import jiramail
+
+logger = jiramail.logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    key   INTEGER PRIMARY KEY AUTOINCREMENT,
+    msgid TEXT UNIQUE,
+    issue TEXT,
+    date  INTEGER NOT NULL DEFAULT 0,
+    flags TEXT NOT NULL DEFAULT '',
+    data  BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_issue ON messages (issue);
+"""
+
+
+def mail_date(mail: email.message.Message) -> int:
+    try:
+        return int(email.utils.parsedate_to_datetime(str(mail.get("Date"))).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+
+def mail_bytes(mail: email.message.Message) -> bytes:
+    buf = io.BytesIO()
+    email.generator.BytesGenerator(buf, False, 0).flatten(mail)
+    return buf.getvalue()
+
+
+class SqliteMailbox(jiramail.Mailbox):
+    """
+    Messages are stored in an SQLite database. Lookups by key and by
+    Message-Id use the indexes of the database, so there is nothing to scan
+    when the mailbox is opened and duplicates are rejected by the UNIQUE
+    constraint instead of the in-memory set of Message-Ids.
+
+    Other processes can write to the database at the same time, so a write
+    transaction is kept open only inside batch() and only for a group of
+    messages. Other changes are committed right away.
+    """
+    def __init__(self, path: str):
+        super().__init__(path)
+
+        self.db = sqlite3.connect(self.path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+        self.n_msgs = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+        # Messages inserted in the current transaction of the batch.
+        self.batch_size = 0
+        self.batching = 0
+        self.pending = 0
+
+        logger.info("mailbox is ready")
+
+    def fetch(self, key: Any, column: str) -> Any:
+        row = self.db.execute(f"SELECT {column} FROM messages WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row
+
+    def get_message(self, key: Any) -> mailbox.mboxMessage:
+        date, flags, data = self.fetch(key, "date, flags, data")
+
+        mail = mailbox.mboxMessage(data)
+        mail.set_from("MAILER-DAEMON", time.gmtime(date))
+        mail.set_flags(flags)
+
+        return mail
+
+    def get_flags(self, key: Any) -> str:
+        return str(self.fetch(key, "flags")[0])
+
+    def set_flags(self, key: Any, flags: str) -> None:
+        self.db.execute("UPDATE messages SET flags = ? WHERE key = ?", (flags, key))
+
+    def del_message(self, key: Any) -> None:
+        if self.db.execute("DELETE FROM messages WHERE key = ?", (key,)).rowcount == 0:
+            raise KeyError(key)
+        self.n_msgs -= 1
+        self.generation += 1
+
+    def update_message(self, key: Any, mail: email.message.Message) -> None:
+        self.db.execute("UPDATE messages SET flags = ?, data = ? WHERE key = ?",
+                        (jiramail.mail_flags(mail), mail_bytes(mail), key))
+
+    def begin(self) -> None:
+        if self.batching and not self.db.in_transaction:
+            self.db.execute("BEGIN")
+
+    def commit(self) -> None:
+        if self.db.in_transaction:
+            self.db.execute("COMMIT")
+        self.pending = 0
+
+    @contextlib.contextmanager
+    def batch(self, size: int = jiramail.BATCH_SIZE) -> Iterator[None]:
+        """
+        Messages added inside the batch are inserted by groups of the
+        specified size in one transaction.
+        """
+        prev_size = self.batch_size
+
+        self.batch_size = size
+        self.batching += 1
+        try:
+            yield
+        finally:
+            self.batching -= 1
+            self.batch_size = prev_size
+            if not self.batching:
+                self.commit()
+
+    def insert(self, mail: email.message.Message) -> bool:
+        msg_id: Optional[str] = mail.get("Message-Id")
+        issue_id: Optional[str] = mail.get("X-Jiramail-Issue-Id")
+
+        self.begin()
+
+        cur = self.db.execute("INSERT OR IGNORE INTO messages (msgid, issue, date, flags, data) VALUES (?, ?, ?, ?, ?)",
+                              (str(msg_id) if msg_id else None,
+                               str(issue_id) if issue_id else None,
+                               mail_date(mail),
+                               jiramail.mail_flags(mail),
+                               mail_bytes(mail)))
+
+        if self.db.in_transaction:
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.commit()
+
+        return cur.rowcount > 0
+
+    def add_message(self, mail: email.message.Message) -> None:
+        self.insert(mail)
+
+    def append(self, mail: email.message.Message) -> None:
+        if self.insert(mail):
+            self.n_msgs += 1
+            self.generation += 1
+
+    def iterkeys(self) -> Iterator[Any]:
+        return iter([row[0] for row in self.db.execute("SELECT key FROM messages ORDER BY key")])
+
+    def refresh(self) -> bool:
+        # SQLite takes care of locking, the messages of other processes are
+        # visible once they are committed.
+        n_msgs = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        if n_msgs == self.n_msgs:
+            return False
+        self.n_msgs = n_msgs
+        self.generation += 1
+        return True
+
+    def compact(self) -> None:
+        self.commit()
+        self.db.execute("VACUUM")
+
+    def sync(self) -> None:
+        self.commit()
+
+    def close(self) -> None:
+        self.commit()
+        self.db.close()
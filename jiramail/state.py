@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import json
+import os
+import os.path
+
+from typing import Optional, Dict, List, Tuple, Any
+
+import jiramail
+import jiramail.index
+
+logger = jiramail.logger
+
+
+def state_path(mailbox: str, suffix: str) -> str:
+    return jiramail.index.sidecar_path(os.path.abspath(os.path.expanduser(mailbox)), suffix)
+
+
+def read_json(path: str) -> Any:
+    try:
+        with open(path, "r", encoding="utf-8") as fd:
+            return json.load(fd)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path: str, data: Any) -> None:
+    with jiramail.index.replace_file(path) as fd:
+        json.dump(data, fd)
+
+
+class Journal:
+    """
+    A dictionary kept in a file next to the mailbox. The file holds a JSON
+    object per line and the later lines override the earlier ones. A save
+    appends only the entries changed since the previous save, so its cost
+    does not depend on the number of entries. The file is rewritten when
+    the lines hold much more entries than the dictionary.
+    """
+    def __init__(self, mailbox: str, suffix: str):
+        self.path = state_path(mailbox, suffix)
+        self.entries: Dict[str, Any] = {}
+
+        # The entries changed since the last save.
+        self.pending: Dict[str, Any] = {}
+
+        # The number of entries in the lines of the file.
+        self.written = 0
+
+        # The file has to be rewritten on the next save.
+        self.rewrite = False
+
+    def valid(self, value: Any) -> bool:
+        return value is not None
+
+    def load(self) -> None:
+        try:
+            with open(self.path, "r", encoding="utf-8") as fd:
+                for line in fd:
+                    try:
+                        data = json.loads(line)
+                    except ValueError:
+                        data = None
+
+                    # A line cut short by an interrupted save or the file
+                    # written at once by an older version.
+                    if not line.endswith("\n") or not isinstance(data, dict):
+                        self.rewrite = True
+                        if not isinstance(data, dict):
+                            continue
+
+                    self.written += len(data)
+                    self.entries.update((str(k), v) for k, v in data.items())
+        except OSError:
+            return
+
+        self.entries = {k: v for k, v in self.entries.items() if self.valid(v)}
+
+    def get(self, key: str) -> Any:
+        return self.entries.get(key)
+
+    def set(self, key: str, value: Any) -> None:
+        if self.entries.get(key) != value:
+            self.entries[key] = value
+            self.pending[key] = value
+
+    def save(self) -> None:
+        if not self.pending and not self.rewrite:
+            return
+
+        # Small files are cheap to read, so they are not rewritten often.
+        if self.written + len(self.pending) > 2 * len(self.entries) + 1000:
+            self.rewrite = True
+
+        try:
+            if self.rewrite:
+                with jiramail.index.replace_file(self.path) as fd:
+                    if self.entries:
+                        fd.write(json.dumps(self.entries) + "\n")
+                self.written = len(self.entries)
+            else:
+                with open(self.path, "a", encoding="utf-8") as fd:
+                    fd.write(json.dumps(self.pending) + "\n")
+                self.written += len(self.pending)
+        except OSError as e:
+            logger.warning("unable to save %s: %s", self.path, e)
+            return
+
+        self.pending = {}
+        self.rewrite = False
+
+
+class IssueState(Journal):
+    """
+    The value of the `updated` field of each issue at the time the issue was
+    written to the mailbox. It is kept in the .<name>.issues file next to the
+    mailbox and allows to skip issues that have not changed since then.
+    """
+    def __init__(self, mailbox: str):
+        super().__init__(mailbox, "issues")
+
+    def valid(self, value: Any) -> bool:
+        return isinstance(value, str)
+
+    def get(self, key: str) -> Optional[str]:
+        updated: Optional[str] = self.entries.get(key)
+        return updated
+
+
+class IssueMarks(Journal):
+    """
+    The point up to which the changes and comments of each issue have been
+    written to the mailbox. It is kept in the .<name>.marks file next to the
+    mailbox, so only newer changes and comments of a known issue are
+    requested and rendered. A mark of an issue is a dictionary:
+
+    history  - the number of changes and the id of the last of them;
+    comment  - the number of comments and the id of the last of them;
+    version  - the version of the issue email;
+    date     - the date of the issue email;
+    summary  - the summary set by the changes, if any.
+    """
+    def __init__(self, mailbox: str):
+        super().__init__(mailbox, "marks")
+
+    def valid(self, value: Any) -> bool:
+        return isinstance(value, dict) and "history" in value and "comment" in value
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        mark: Optional[Dict[str, Any]] = self.entries.get(key)
+        return mark
+
+
+def issue_mark(n_histories: int, last_history: str, version: int, date: str,
+               summary: Optional[str]) -> Dict[str, Any]:
+    mark: Dict[str, Any] = {"history": [n_histories, last_history], "version": version, "date": date}
+    if summary is not None:
+        mark["summary"] = summary
+    return mark
+
+
+class Checkpoint:
+    """
+    Progress of the queries of a long run. It is kept in the .<name>.resume
+    file next to the mailbox and is saved each time a page of issues has
+    been written to the mailbox, so the run can be resumed with --resume
+    after the last saved page.
+    """
+    def __init__(self, mailbox: str):
+        self.path = state_path(mailbox, "resume")
+
+        # The queries that are complete.
+        self.done: List[str] = []
+
+        # The queries in progress: the number of their issues written to
+        # the mailbox and the key of the last of them. Several shards of a
+        # query can be in progress at the same time.
+        self.progress: Dict[str, Tuple[int, str]] = {}
+
+        # The shards planned for the queries, so a resumed run pages
+        # through the same shards.
+        self.shards: Dict[str, List[str]] = {}
+
+    def load(self) -> None:
+        data = read_json(self.path)
+        if not isinstance(data, dict):
+            return
+
+        progress = data.get("progress")
+        if isinstance(progress, dict):
+            for query, value in progress.items():
+                try:
+                    self.progress[str(query)] = (int(value[0]), str(value[1]))
+                except (TypeError, ValueError, IndexError):
+                    continue
+
+        self.done = [str(x) for x in data.get("done", [])]
+
+        shards = data.get("shards")
+        if isinstance(shards, dict):
+            self.shards = {str(k): [str(x) for x in v] for k, v in shards.items() if isinstance(v, list)}
+
+    def save(self) -> None:
+        try:
+            write_json(self.path, {
+                "done": self.done,
+                "progress": self.progress,
+                "shards": self.shards,
+                })
+        except OSError as e:
+            logger.warning("unable to save checkpoint: %s", e)
+
+    def is_done(self, query: str) -> bool:
+        return query in self.done
+
+    def resume_at(self, query: str) -> Optional[Tuple[int, str]]:
+        position, key = self.progress.get(query, (0, ""))
+        if position <= 0 or not key:
+            return None
+        return position, key
+
+    def planned(self, query: str) -> Optional[List[str]]:
+        return self.shards.get(query)
+
+    def plan(self, query: str, shards: List[str]) -> None:
+        self.shards[query] = shards
+        self.save()
+
+    def update(self, query: str, position: int, key: str) -> None:
+        self.progress[query] = (position, key)
+        self.save()
+
+    def finish(self, query: str) -> None:
+        if query not in self.done:
+            self.done.append(query)
+        self.shards.pop(query, None)
+        self.progress.pop(query, None)
+        self.save()
+
+    def remove(self) -> None:
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning("unable to remove checkpoint: %s", e)
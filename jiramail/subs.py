@@ -5,17 +5,29 @@
 __author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
 
 import argparse
+import math
 import multiprocessing
 import re
+import time
 
-from typing import Dict, List, Any
+from typing import Optional, Dict, List, Any
 
 import jiramail
+import jiramail.fetch
 import jiramail.mbox
+import jiramail.pipeline
+import jiramail.render
+import jiramail.shard
+import jiramail.state
+import jiramail.throttle
 
 logger = jiramail.logger
 config_section = "sub"
 
+# Issues updated this many minutes before the last sync are requested again.
+# This covers the clock skew between hosts and the minute precision of JQL.
+WATERMARK_SKEW = 10
+
 
 def get_mailbox(config: Dict[str, Any], name: str) -> str:
     if name not in config[config_section]:
@@ -23,6 +35,62 @@ def get_mailbox(config: Dict[str, Any], name: str) -> str:
     return str(config[config_section][name]["mbox"])
 
 
+def get_format(config: Dict[str, Any], name: str) -> str:
+    if name not in config[config_section]:
+        return ""
+    return str(config[config_section][name].get("format", ""))
+
+
+def get_section(config: Dict[str, Any], name: str) -> Dict[str, Any]:
+    section: Dict[str, Any] = config[config_section].get(name, {})
+    return section
+
+
+def get_batch_size(config: Dict[str, Any], name: str) -> int:
+    return max(1, int(jiramail.config_number(get_section(config, name), "batch_size", jiramail.BATCH_SIZE)))
+
+
+def get_jobs(config: Dict[str, Any], name: str) -> int:
+    return max(1, int(jiramail.config_number(get_section(config, name), "jobs", 1)))
+
+
+def get_shard_size(config: Dict[str, Any], name: str) -> int:
+    return max(0, int(jiramail.config_number(get_section(config, name), "shard_size", 0)))
+
+
+def get_shard_field(config: Dict[str, Any], name: str) -> str:
+    value = str(get_section(config, name).get("shard_field", "created"))
+    if value not in jiramail.shard.SHARD_FIELDS:
+        logger.warning("section `%s.%s': unknown shard field `%s', using `created'", config_section, name, value)
+        return "created"
+    return value
+
+
+def get_fields(config: Dict[str, Any], name: str) -> Optional[List[str]]:
+    if name not in config[config_section]:
+        return None
+    return jiramail.mbox.parse_fields(str(config[config_section][name].get("fields", "")))
+
+
+def get_incremental(config: Dict[str, Any], name: str) -> bool:
+    return jiramail.config_bool(get_section(config, name), "incremental", True)
+
+
+def get_only_changed(config: Dict[str, Any], name: str) -> bool:
+    return jiramail.config_bool(get_section(config, name), "only_changed", False)
+
+
+def incremental_query(query: str, since: float) -> str:
+    """
+    Limits the query to the issues updated since the previous sync. The
+    relative date is used because JQL dates are in the timezone of the jira
+    user.
+    """
+    minutes = math.ceil(max(0, time.time() - since) / 60) + WATERMARK_SKEW
+    query = re.sub(r'\s+ORDER\s+BY\s.*$', '', query, flags=re.IGNORECASE | re.DOTALL)
+    return f"({query}) AND updated >= -{minutes}m ORDER BY updated"
+
+
 def get_queries(config: Dict[str, Any], name: str) -> List[str]:
     queries: List[str] = []
 
@@ -40,12 +108,18 @@ def get_queries(config: Dict[str, Any], name: str) -> List[str]:
     return queries
 
 
-def sync_mailbox(config: Dict[str, Any], mailbox: str, queries: Dict[str, List[str]]) -> int:
+def sync_mailbox(config: Dict[str, Any], mailbox: str, fmt: str, queries: Dict[str, List[str]],
+                 full: bool) -> int:
     logger = jiramail.setup_logger(multiprocessing.get_logger(),
                                    level=jiramail.logger.level,
                                    fmt="[%(asctime)s] pid=%(process)d: %(message)s")
     jiramail.logger = logger
     jiramail.mbox.logger = logger
+    jiramail.pipeline.logger = logger
+    jiramail.render.logger = logger
+    jiramail.fetch.logger = logger
+    jiramail.shard.logger = logger
+    jiramail.throttle.logger = logger
 
     logger.critical("process started for `%s'", mailbox)
 
@@ -56,25 +130,73 @@ def sync_mailbox(config: Dict[str, Any], mailbox: str, queries: Dict[str, List[s
         return jiramail.EX_FAILURE
 
     try:
-        mbox = jiramail.Mailbox(mailbox)
+        mbox = jiramail.open_mailbox(mailbox, fmt)
     except Exception as e:
         logger.critical("unable to open mailbox: %s", e)
         return jiramail.EX_FAILURE
 
+    state_path = jiramail.state.state_path(mailbox, "subs")
+    watermarks = jiramail.state.read_json(state_path)
+    if not isinstance(watermarks, dict):
+        watermarks = {}
+
+    # The watermarks are useless if the mailbox has been removed.
+    full = full or mbox.n_msgs == 0
+
+    issues = jiramail.state.IssueState(mailbox)
+    marks = jiramail.state.IssueMarks(mailbox)
+    if not full:
+        issues.load()
+        marks.load()
+
+    pipeline = jiramail.pipeline.Pipeline(mbox)
+    pipeline.marks = marks
+
     for target in queries.keys():
         logger.info("syncing subscription `%s' to `%s' ...", target, mailbox)
 
-        for query in queries[target]:
-            jiramail.mbox.process_query(query, mbox)
+        started = time.time()
+        since = None
+
+        mark = watermarks.get(target)
+
+        if (not full and get_incremental(config, target) and isinstance(mark, dict) and
+                mark.get("queries") == queries[target] and isinstance(mark.get("time"), (int, float))):
+            since = float(mark["time"])
+            logger.info("requesting issues updated since %s", time.ctime(since))
+
+        state = issues if get_only_changed(config, target) else None
+        pipeline.jobs = get_jobs(config, target)
+        pipeline.shard_size = get_shard_size(config, target)
+        pipeline.shard_field = get_shard_field(config, target)
+
+        with mbox.batch(get_batch_size(config, target)):
+            for query in queries[target]:
+                if since is not None:
+                    query = incremental_query(query, since)
+                jiramail.mbox.process_query(query, pipeline, state, pipeline.jobs,
+                                            get_fields(config, target))
+
+        issues.save()
+        marks.save()
+
+        watermarks[target] = {
+                "queries": queries[target],
+                "time": started,
+                }
+        try:
+            jiramail.state.write_json(state_path, watermarks)
+        except OSError as e:
+            logger.warning("unable to save sync state: %s", e)
 
         logger.critical("section `%s' synced", target)
 
     mbox.close()
+    jiramail.jserv.report()
 
     return jiramail.EX_SUCCESS
 
 
-# pylint: disable-next=unused-argument
 def main(cmdargs: argparse.Namespace) -> int:
     config = jiramail.read_config()
 
@@ -86,11 +208,12 @@ def main(cmdargs: argparse.Namespace) -> int:
         return jiramail.EX_SUCCESS
 
     mailboxes: Dict[str, Dict[str, List[str]]] = {}
+    formats: Dict[str, str] = {}
 
     for target in config[config_section]:
         section = config[config_section][target]
 
-        if "skip" in section and re.match(r'^(1|on|yes|true)$', section["skip"], re.IGNORECASE):
+        if jiramail.config_bool(section, "skip", False):
             logger.info("syncing section `%s' skipped", target)
             continue
 
@@ -106,18 +229,35 @@ def main(cmdargs: argparse.Namespace) -> int:
 
         mailboxes[mailbox][target] = get_queries(config, target)
 
+        fmt = get_format(config, target)
+
+        if fmt:
+            if formats.get(mailbox, fmt) != fmt:
+                logger.critical("sections for the mailbox `%s' specify different formats.", mailbox)
+                return jiramail.EX_FAILURE
+            formats[mailbox] = fmt
+
     nprocs = min(5, len(mailboxes.keys()))
 
     if nprocs == 0:
         return jiramail.EX_SUCCESS
 
+    if cmdargs.refresh_meta:
+        # The workers take the field metadata from the cache updated here.
+        try:
+            jiramail.Connection(config.get("jira", {}), refresh_meta=True).fill_fields()
+        except Exception as e:
+            logger.critical("unable to refresh field metadata: %s", e)
+            return jiramail.EX_FAILURE
+
     ret = jiramail.EX_SUCCESS
 
     with multiprocessing.Pool(processes=nprocs) as pool:
         results = []
 
         for mailbox, queries in mailboxes.items():
-            results.append(pool.apply_async(sync_mailbox, (config, mailbox, queries,)))
+            results.append(pool.apply_async(sync_mailbox, (config, mailbox, formats.get(mailbox, ""), queries,
+                                                           cmdargs.full,)))
 
         for result in results:
             rc = result.get()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: GPL-3.0-or-later
+# Copyright (C) 2023  Alexey Gladkov <gladkov.alexey@gmail.com>
+
+__author__ = 'Alexey Gladkov <gladkov.alexey@gmail.com>'
+
+import fcntl
+import os
+import os.path
+import struct
+import threading
+import time
+
+from typing import Optional, List, Callable, Any
+
+import requests
+import requests.adapters
+
+import jiramail
+
+logger = jiramail.logger
+
+# The state of the token bucket: the number of tokens, the time it was
+# updated, the current rate, the time until which requests are not allowed
+# and the average latency.
+STATE_FORMAT = "ddddd"
+STATE_SIZE = struct.calcsize(STATE_FORMAT)
+
+# The rate is decreased this many times when jira asks to slow down.
+BACKOFF_FACTOR = 0.5
+
+# The rate does not go lower than this number of requests per second.
+MIN_RATE = 0.5
+
+# A response that takes this many times longer than the average one means
+# that the server is overloaded. The rate is decreased a little then.
+LATENCY_FACTOR = 4.0
+LATENCY_BACKOFF_FACTOR = 0.9
+
+# The time in seconds to wait after 429 or 503 without Retry-After.
+RETRY_AFTER = 10.0
+
+
+class RequestScheduler:
+    """
+    Token bucket shared by all processes that use the same jira server. The
+    state of the bucket is kept in a file under the exclusive lock, so the
+    workers of `subs` and concurrent runs share one budget of requests. The
+    rate is halved when jira answers with 429 or 503 or fails, it is lowered
+    a little when the responses become much slower than usual, and it grows
+    back slowly with each successful request up to `max_rate`.
+    """
+    def __init__(self, path: str, max_rate: float):
+        self.path = path
+        self.max_rate = max_rate
+        self.burst = max(1.0, max_rate)
+        self.mutex = threading.Lock()
+        self.fd = -1
+
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            logger.warning("unable to open the request scheduler state: %s", e)
+
+        # Statistics of this process.
+        self.started = 0.0
+        self.requests = 0
+        self.throttled = 0.0
+        self.rejected = 0
+
+    def read_state(self, now: float) -> List[float]:
+        data = os.pread(self.fd, STATE_SIZE, 0)
+        if len(data) != STATE_SIZE:
+            return [self.burst, now, self.max_rate, 0.0, 0.0]
+        state = list(struct.unpack(STATE_FORMAT, data))
+        # The limit could be changed in the config since the last run.
+        state[2] = min(max(state[2], MIN_RATE), self.max_rate)
+        return state
+
+    def write_state(self, state: List[float]) -> None:
+        os.pwrite(self.fd, struct.pack(STATE_FORMAT, *state), 0)
+
+    def update(self, func: Callable[[List[float], float], Any]) -> Any:
+        with self.mutex:
+            if self.fd < 0:
+                return None
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                state = self.read_state(now)
+                ret = func(state, now)
+                self.write_state(state)
+                return ret
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def take(self, state: List[float], now: float) -> float:
+        tokens, stamp, rate, blocked, _ = state
+
+        tokens = min(self.burst, tokens + max(0.0, now - stamp) * rate)
+        state[0], state[1] = tokens, now
+
+        if blocked > now:
+            return blocked - now
+
+        if tokens < 1:
+            return (1 - tokens) / rate
+
+        state[0] = tokens - 1
+        return 0.0
+
+    def acquire(self) -> None:
+        if not self.started:
+            self.started = time.time()
+
+        while True:
+            delay = self.update(self.take)
+            if not delay:
+                break
+            self.throttled += delay
+            time.sleep(delay)
+
+        self.requests += 1
+
+    def slow_down(self, state: List[float], now: float, retry_after: Optional[float]) -> None:
+        state[2] = max(MIN_RATE, state[2] * BACKOFF_FACTOR)
+        if retry_after is not None:
+            state[3] = max(state[3], now + retry_after)
+        logger.debug("reducing the rate of requests to %.1f/s", state[2])
+
+    def release(self, latency: float, status: Optional[int], retry_after: Optional[float]) -> None:
+        def func(state: List[float], now: float) -> None:
+            if status in (429, 503):
+                self.slow_down(state, now, RETRY_AFTER if retry_after is None else retry_after)
+                return
+
+            if status is None or status >= 500:
+                self.slow_down(state, now, None)
+                return
+
+            average = state[4] or latency
+            state[4] = average * 0.9 + latency * 0.1
+
+            if latency > average * LATENCY_FACTOR:
+                state[2] = max(MIN_RATE, state[2] * LATENCY_BACKOFF_FACTOR)
+            else:
+                state[2] = min(self.max_rate, state[2] + self.max_rate / 100)
+
+        if status in (429, 503):
+            self.rejected += 1
+
+        self.update(func)
+
+    def report(self) -> None:
+        if not self.requests:
+            return
+        elapsed = max(time.time() - self.started, 1e-3)
+        logger.info("jira requests: %d (%.1f/s), throttled for %.1fs, rejected by jira: %d",
+                    self.requests, self.requests / elapsed, self.throttled, self.rejected)
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def get_retry_after(response: requests.Response) -> Optional[float]:
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class ThrottledAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter that passes every HTTP request to jira, including the
+    retries of the jira module, through the request scheduler.
+    """
+    def __init__(self, scheduler: RequestScheduler, **kwargs: Any):
+        self.scheduler = scheduler
+        super().__init__(**kwargs)
+
+    def send(self, request: requests.PreparedRequest, *args: Any, **kwargs: Any) -> requests.Response:
+        self.scheduler.acquire()
+
+        started = time.monotonic()
+        try:
+            response = super().send(request, *args, **kwargs)
+        except requests.RequestException:
+            self.scheduler.release(time.monotonic() - started, None, None)
+            raise
+
+        self.scheduler.release(time.monotonic() - started, response.status_code,
+                               get_retry_after(response))
+        return response